@@ -0,0 +1,173 @@
+#!/usr/bin/python
+"""Generates synthetic TOMOYO policies for benchmarking"""
+
+import getopt
+import os
+import random
+import sys
+
+# programs executed by domains
+PROGRAM_DIRS = ["/bin", "/sbin", "/usr/bin", "/usr/sbin", "/usr/lib/%s", "/usr/libexec/%s", "/opt/%s/bin"]
+# files accessed by domains
+FILE_DIRS = ["/etc", "/etc/%s", "/usr/share/%s", "/var/lib/%s", "/var/log/%s", "/tmp", "/home/\\*/.%s", "/proc/\\$"]
+FILE_ACLS = ["allow_read", "allow_read", "allow_read", "allow_write", "allow_read/write",
+        "allow_execute", "allow_create", "allow_unlink", "allow_truncate", "allow_rewrite"]
+DIR_ACLS = ["allow_mkdir", "allow_rmdir"]
+PATH_ACLS = ["allow_rename", "allow_link"]
+
+def usage():
+    """Prints help message"""
+    print """Generates synthetic TOMOYO policies.
+
+Usage: gen-policy.py [options] <directory>
+
+Writes domain_policy.conf, exception_policy.conf and import.conf into directory.
+
+Options:
+    -h, --help              displays this helpful message.
+    -n, --domains <number>  number of domains (default: 10000)
+    -D, --depth <number>    maximum depth of domain transitions (default: 16)
+    -a, --acl <number>      average number of ACL entries per domain (default: 8)
+    -e, --exceptions <number>
+                            number of exceptions (default: 1000)
+    -s, --seed <number>     random seed (default: 0)
+"""
+
+class PolicyGenerator:
+    def __init__(self, num_domains, depth=16, acl=8, num_exceptions=1000, seed=0):
+        """Initializes the generator"""
+        self.num_domains = num_domains
+        self.depth = depth
+        self.acl = acl
+        self.num_exceptions = num_exceptions
+        self.random = random.Random(seed)
+        # pool of known programs, so domains transitions are shared between chains
+        self.programs = [self.program() for i in range(max(num_domains / 4, 16))]
+
+    def name(self):
+        """Returns a random file name"""
+        length = self.random.randint(3, 10)
+        return "".join([self.random.choice("abcdefghijklmnopqrstuvwxyz0123456789-_") for i in range(length)])
+
+    def program(self):
+        """Returns a random program path"""
+        path = self.random.choice(PROGRAM_DIRS)
+        if "%s" in path:
+            path = path % self.name()
+        return "%s/%s" % (path, self.name())
+
+    def path(self, program):
+        """Returns a random file path accessed by program"""
+        path = self.random.choice(FILE_DIRS)
+        if "%s" in path:
+            path = path % os.path.basename(program)
+        if self.random.random() < 0.1:
+            return "%s/\\*" % path
+        return "%s/%s" % (path, self.name())
+
+    def domains(self):
+        """Returns a sorted list of domains.
+
+        Most domains are children of recent ones, which builds deep transition chains."""
+        domains = ["<kernel>", "<kernel> /sbin/init"]
+        known = set(domains)
+        while len(domains) < self.num_domains:
+            if self.random.random() < 0.6:
+                parent = domains[-1]
+            else:
+                parent = self.random.choice(domains)
+            if parent.count(" ") >= self.depth:
+                parent = "<kernel> /sbin/init"
+            domain = "%s %s" % (parent, self.random.choice(self.programs))
+            if domain not in known:
+                known.add(domain)
+                domains.append(domain)
+        domains.sort()
+        return domains
+
+    def acl_entries(self, domain):
+        """Returns ACL of a domain, with a few domains having very large ACL"""
+        program = domain.rsplit(" ", 1)[-1]
+        count = int(self.random.paretovariate(1.2) * self.acl / 6)
+        count = min(count, self.acl * 500)
+        entries = []
+        for i in range(count):
+            kind = self.random.random()
+            if kind < 0.85:
+                entries.append("%s %s" % (self.random.choice(FILE_ACLS), self.path(program)))
+            elif kind < 0.95:
+                entries.append("%s %s/" % (self.random.choice(DIR_ACLS), self.path(program)))
+            else:
+                entries.append("%s %s %s" % (self.random.choice(PATH_ACLS), self.path(program), self.path(program)))
+        return entries
+
+    def write_policy(self, filename, domains):
+        """Writes a domain policy"""
+        with open(filename, "w") as fd:
+            for domain in domains:
+                fd.write("%s\n\nuse_profile %d\n\n" % (domain, self.random.choice([0, 1, 1, 2, 3])))
+                for entry in self.acl_entries(domain):
+                    fd.write("%s\n" % entry)
+                fd.write("\n")
+
+    def write_exceptions(self, filename):
+        """Writes an exception policy"""
+        with open(filename, "w") as fd:
+            for i in range(self.num_exceptions):
+                kind = self.random.random()
+                program = self.random.choice(self.programs)
+                if kind < 0.5:
+                    fd.write("allow_read %s\n" % self.path(program))
+                elif kind < 0.7:
+                    fd.write("file_pattern %s\n" % self.path(program))
+                elif kind < 0.8:
+                    fd.write("initialize_domain %s\n" % program)
+                elif kind < 0.9:
+                    fd.write("keep_domain <kernel> /sbin/init %s\n" % program)
+                elif kind < 0.95:
+                    fd.write("alias %s %s\n" % (program, self.random.choice(self.programs)))
+                else:
+                    fd.write("deny_rewrite %s\n" % self.path(program))
+
+    def generate(self, directory):
+        """Writes policy, exceptions and a policy to import into directory"""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        domains = self.domains()
+        self.write_policy(os.path.join(directory, "domain_policy.conf"), domains)
+        self.write_exceptions(os.path.join(directory, "exception_policy.conf"))
+        # one domain out of ten is imported again, with new ACL
+        self.write_policy(os.path.join(directory, "import.conf"), domains[::10])
+
+if __name__ == "__main__":
+    num_domains = 10000
+    depth = 16
+    acl = 8
+    num_exceptions = 1000
+    seed = 0
+
+    # parse command line
+    try:
+        opt, args = getopt.getopt(sys.argv[1:], 'hn:D:a:e:s:', ['help', 'domains=', 'depth=', 'acl=', 'exceptions=', 'seed='])
+        for o in opt:
+            if o[0] == '-h' or o[0] == '--help':
+                usage()
+                sys.exit(0)
+            elif o[0] == '-n' or o[0] == '--domains':
+                num_domains = int(o[1])
+            elif o[0] == '-D' or o[0] == '--depth':
+                depth = int(o[1])
+            elif o[0] == '-a' or o[0] == '--acl':
+                acl = int(o[1])
+            elif o[0] == '-e' or o[0] == '--exceptions':
+                num_exceptions = int(o[1])
+            elif o[0] == '-s' or o[0] == '--seed':
+                seed = int(o[1])
+    except (getopt.error, ValueError):
+        usage()
+        sys.exit(1)
+    if len(args) != 1:
+        usage()
+        sys.exit(1)
+
+    PolicyGenerator(num_domains, depth, acl, num_exceptions, seed).generate(args[0])
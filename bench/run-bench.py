@@ -0,0 +1,246 @@
+#!/usr/bin/python
+"""Benchmarks TOMOYO policy operations on synthetic policies"""
+
+import getopt
+import imp
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+GUI_DIR = os.path.join(os.path.dirname(BENCH_DIR), "gui")
+sys.path.insert(0, GUI_DIR)
+
+from tomoyo_policy import TomoyoPolicy, TomoyoExceptions
+
+# benchmarked operations, run in that order
+OPERATIONS = ["read_policy", "read_policy_acl", "read_exceptions", "import_policy", "write_policy",
+        "refresh_domains", "show_domain_details"]
+# operations which need GTK and a display
+GUI_OPERATIONS = ["refresh_domains", "show_domain_details"]
+SIZES = [1000, 10000, 100000]
+
+def usage():
+    """Prints help message"""
+    print """Benchmarks TOMOYO policy operations.
+
+Usage: run-bench.py [options]
+
+Options:
+    -h, --help              displays this helpful message.
+    -n, --domains <list>    comma-separated sizes of generated policies
+                            (default: %s)
+    -o, --operations <list> comma-separated operations to run
+                            (default: %s)
+    -r, --repeat <number>   number of runs of each operation, best one is kept
+                            (default: 3)
+    -d, --data <dir>        location of generated policies
+                            (default: %s)
+    -s, --save <file>       store results into file
+    -c, --compare <file>    compare results with ones stored in file
+""" % (",".join(map(str, SIZES)), ",".join(OPERATIONS), default_data_dir())
+
+def default_data_dir():
+    """Returns default location of generated policies"""
+    return os.path.join(tempfile.gettempdir(), "tomoyo-bench")
+
+def policy_version():
+    """Returns version of benchmarked code"""
+    try:
+        version = imp.load_source("version", os.path.join(GUI_DIR, "version.py")).version
+    except:
+        version = "unknown"
+    try:
+        proc = subprocess.Popen(["git", "describe", "--always", "--dirty"], cwd=BENCH_DIR,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        if proc.returncode == 0:
+            version = "%s-%s" % (version, out.strip())
+    except OSError:
+        pass
+    return version
+
+def generate(directory, num_domains):
+    """Generates a synthetic policy if it does not exist yet"""
+    if os.path.exists(os.path.join(directory, "import.conf")):
+        return
+    print "Generating policy with %d domains in %s" % (num_domains, directory)
+    status = subprocess.call([sys.executable, os.path.join(BENCH_DIR, "gen-policy.py"), "-n", str(num_domains), directory])
+    if status != 0:
+        print >>sys.stderr, "Unable to generate policy in %s" % directory
+        sys.exit(1)
+
+def new_policy(directory):
+    """Returns policy and exceptions reading from generated files, without touching kernel"""
+    policy = TomoyoPolicy(policy="file")
+    policy.location = os.path.join(directory, "domain_policy.conf")
+    exceptions = TomoyoExceptions(policy="file")
+    exceptions.exceptions_location = os.path.join(directory, "exception_policy.conf")
+    return policy, exceptions
+
+def load_gui():
+    """Loads GUI module, returning None if GTK or a display is not available"""
+    try:
+        import gtk
+    except:
+        return None
+    if not gtk.gdk.display_get_default():
+        return None
+    gui = imp.load_source("tomoyo_gui", os.path.join(GUI_DIR, "tomoyo-gui.py"))
+    # policy is loaded by the benchmark, not in background
+    gui.TomoyoGui.load_policy = lambda self: None
+    return gui
+
+def process_events():
+    """Processes pending GTK events, so widgets are actually drawn"""
+    import gtk
+    while gtk.events_pending():
+        gtk.main_iteration(False)
+
+def run_operation(operation, directory):
+    """Runs an operation, returning time spent in it.
+
+    Only the operation itself is timed, not loading the policy it works on."""
+    policy, exceptions = new_policy(directory)
+    if operation == "read_policy":
+        start = time.time()
+        policy.update(policy.load())
+    elif operation == "read_policy_acl":
+        start = time.time()
+        policy.update(policy.load())
+        for domain in policy.policy:
+            policy.policy_dict[domain]
+    elif operation == "read_exceptions":
+        start = time.time()
+        exceptions.update(exceptions.load())
+    elif operation == "import_policy":
+        policy.update(policy.load())
+        start = time.time()
+        policy.import_policy(os.path.join(directory, "import.conf"), merge=True)
+    elif operation == "write_policy":
+        policy.update(policy.load())
+        fd, filename = tempfile.mkstemp(prefix="domain_policy.", dir=directory)
+        os.close(fd)
+        try:
+            start = time.time()
+            policy.write_policy(filename, policy.policy)
+            elapsed = time.time() - start
+        finally:
+            os.unlink(filename)
+        return elapsed
+    elif operation in GUI_OPERATIONS:
+        gui = load_gui()
+        if not gui:
+            return None
+        policy.update(policy.load())
+        exceptions.update(exceptions.load())
+        window = gui.TomoyoGui(policy, exceptions)
+        process_events()
+        if operation == "refresh_domains":
+            start = time.time()
+            window.refresh_domains(reload=False)
+        else:
+            window.refresh_domains(reload=False)
+            process_events()
+            # domain with the largest ACL
+            domain = max(policy.policy, key=lambda domain: len(policy.policy_dict[domain]))
+            start = time.time()
+            window.show_domain_details(domain)
+        process_events()
+    else:
+        raise ValueError("Unknown operation: %s" % operation)
+    return time.time() - start
+
+def run_worker(operation, directory):
+    """Runs an operation in a separate process, returning its time and peak memory"""
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--worker", operation, directory],
+            stdout=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        print >>sys.stderr, "%s failed on %s" % (operation, directory)
+        return None
+    return json.loads(out.splitlines()[-1])
+
+def compare(results, old_results):
+    """Prints changes between two results"""
+    print "%-8s %-20s %10s %10s %8s %10s %10s %8s" % ("domains", "operation", "old time", "time", "", "old KB", "KB", "")
+    for size in sorted(results, key=int):
+        for operation in OPERATIONS:
+            new = results[size].get(operation)
+            old = old_results.get(size, {}).get(operation)
+            if not new or not old:
+                continue
+            print "%-8s %-20s %10.3f %10.3f %+7.0f%% %10d %10d %+7.0f%%" % (size, operation,
+                    old["time"], new["time"], (new["time"] / max(old["time"], 1e-6) - 1) * 100,
+                    old["maxrss"], new["maxrss"], (float(new["maxrss"]) / max(old["maxrss"], 1) - 1) * 100)
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--worker":
+        # a single measure, in a fresh process so peak memory is meaningful
+        elapsed = run_operation(sys.argv[2], sys.argv[3])
+        if elapsed is None:
+            print "null"
+        else:
+            print json.dumps({"time": elapsed, "maxrss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+        sys.exit(0)
+
+    sizes = SIZES
+    operations = OPERATIONS
+    repeat = 3
+    data_dir = default_data_dir()
+    save_file = None
+    compare_file = None
+
+    # parse command line
+    try:
+        opt, args = getopt.getopt(sys.argv[1:], 'hn:o:r:d:s:c:', ['help', 'domains=', 'operations=', 'repeat=', 'data=', 'save=', 'compare='])
+        for o in opt:
+            if o[0] == '-h' or o[0] == '--help':
+                usage()
+                sys.exit(0)
+            elif o[0] == '-n' or o[0] == '--domains':
+                sizes = [int(size) for size in o[1].split(",")]
+            elif o[0] == '-o' or o[0] == '--operations':
+                operations = o[1].split(",")
+            elif o[0] == '-r' or o[0] == '--repeat':
+                repeat = int(o[1])
+            elif o[0] == '-d' or o[0] == '--data':
+                data_dir = o[1]
+            elif o[0] == '-s' or o[0] == '--save':
+                save_file = o[1]
+            elif o[0] == '-c' or o[0] == '--compare':
+                compare_file = o[1]
+    except (getopt.error, ValueError):
+        usage()
+        sys.exit(1)
+    for operation in operations:
+        if operation not in OPERATIONS:
+            print >>sys.stderr, "Unknown operation: %s" % operation
+            sys.exit(1)
+
+    results = {}
+    print "%-8s %-20s %10s %10s" % ("domains", "operation", "time", "peak KB")
+    for size in sizes:
+        directory = os.path.join(data_dir, str(size))
+        generate(directory, size)
+        results[str(size)] = {}
+        for operation in operations:
+            runs = [run_worker(operation, directory) for i in range(repeat)]
+            runs = [run for run in runs if run]
+            if not runs:
+                print "%-8d %-20s %10s" % (size, operation, "skipped")
+                continue
+            best = min(runs, key=lambda run: run["time"])
+            results[str(size)][operation] = best
+            print "%-8d %-20s %10.3f %10d" % (size, operation, best["time"], best["maxrss"])
+
+    if compare_file:
+        with open(compare_file) as fd:
+            compare(results, json.load(fd)["results"])
+    if save_file:
+        with open(save_file, "w") as fd:
+            json.dump({"version": policy_version(), "date": time.strftime("%F %T"), "results": results}, fd, indent=1, sort_keys=True)
@@ -5,13 +5,9 @@ import gobject
 import gtk
 import pango
 
-import gc
 import os
-from stat import *
-import datetime
 import getopt
 import sys
-import traceback
 
 from threading import Thread
 from Queue import Queue
@@ -19,6 +15,9 @@ import time
 
 import textwrap
 
+import tomoyo_policy
+from tomoyo_policy import TomoyoPolicy, TomoyoExceptions, PolicyCache, PolicyHistory, DomainIndex, DomainSearchIndex, PolicyDiff, Profiler, open_policy, profile, run_parallel
+
 DEBUG=False
 
 # localization
@@ -80,6 +79,15 @@ Use the toolbar to refresh current policy from the kernel, or save your settings
 Have a nice TOMOYO experience :)
 """)])
 
+HELP_COMPARE=multiline_help([_("""This view displays the differences between another policy and the current one, including unsaved changes.
+Added domains are marked with +, removed domains with -, and changed domains are followed by their added and removed entries.
+""")])
+
+HELP_PROFILE=multiline_help([_("""This view displays the time and memory spent in each phase of policy handling.
+Objects is the change in the number of objects in memory, and peak is the largest size of the application so far.
+Results are saved when the application is closed.
+""")])
+
 EXCEPTIONS_HELP={
     "alias":
         multiline_help([_("""Specify different paths that point to the same file (e.g., symlinks).""")]),
@@ -128,10 +136,255 @@ class TomoyoInstaller(Thread):
             print "Aborted: %s" % sys.exc_value
             self.finish_install.put(-1)
 
+class LoadCancelled(Exception):
+    """Raised in loader thread when policy loading is cancelled"""
+    pass
+
+class TomoyoLoader(Thread):
+    # tomoyo policy loader
+    def __init__(self, policy, exceptions, progress, finished):
+        """Initializes policy loader.
+
+        Policy and exceptions are loaded in background. progress(text, fraction) is
+        called from gtk main loop while loading, and finished(result) is called when
+        job has ended, with result being None if loading was cancelled or failed.
+        The reason of a failure is stored in self.error."""
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.policy = policy
+        self.exceptions = exceptions
+        self.progress = progress
+        self.finished = finished
+        self.cancelled = False
+        self.error = None
+
+    def cancel(self):
+        """Cancels policy loading"""
+        self.cancelled = True
+
+    def report(self, job, done, total):
+        """Reports loading progress of a job to gtk main loop"""
+        if self.cancelled:
+            raise LoadCancelled()
+        self.done[job] = done
+        self.total[job] = total
+        done = sum(self.done)
+        total = sum(self.total)
+        if total > 0 and 0 not in self.total:
+            fraction = min(float(done) / total, 1.0)
+        else:
+            # size is unknown when reading from kernel
+            fraction = -1
+        gobject.idle_add(self.progress, _("Loading TOMOYO policy (%d KB)...") % (done / 1024), fraction)
+
+    def run(self):
+        """Loads tomoyo policy and exceptions"""
+        # policy and exceptions are loaded at the same time
+        self.done = [0, 0]
+        self.total = [0, 0]
+        try:
+            result = run_parallel(
+                    lambda: self.policy.load(lambda done, total: self.report(0, done, total)),
+                    lambda: self.exceptions.load(lambda done, total: self.report(1, done, total)))
+        except LoadCancelled:
+            if DEBUG:
+                print "Loading cancelled"
+            result = None
+        except Exception:
+            # the progress window must be closed whatever happened
+            self.error = "%s" % sys.exc_value or sys.exc_type.__name__
+            print >>sys.stderr, "Unable to load TOMOYO policy: %s" % self.error
+            result = None
+        gobject.idle_add(self.finished, result)
+
+class LazyListModel(gtk.GenericTreeModel):
+    """Base class for flat lists whose rows are built on demand.
+
+    Row references are row numbers. Subclasses must define COLUMN_TYPES,
+    num_rows() and on_get_value()."""
+    COLUMN_TYPES = ()
+
+    def num_rows(self):
+        """Returns number of rows in the list"""
+        return 0
+
+    def on_get_flags(self):
+        return gtk.TREE_MODEL_LIST_ONLY
+
+    def on_get_n_columns(self):
+        return len(self.COLUMN_TYPES)
+
+    def on_get_column_type(self, n):
+        return self.COLUMN_TYPES[n]
+
+    def on_get_iter(self, path):
+        if path[0] < self.num_rows():
+            return path[0]
+        return None
+
+    def on_get_path(self, rowref):
+        return (rowref,)
+
+    def on_iter_next(self, rowref):
+        if rowref + 1 < self.num_rows():
+            return rowref + 1
+        return None
+
+    def on_iter_children(self, parent):
+        if parent is None and self.num_rows() > 0:
+            return 0
+        return None
+
+    def on_iter_has_child(self, rowref):
+        return False
+
+    def on_iter_n_children(self, rowref):
+        if rowref is None:
+            return self.num_rows()
+        return 0
+
+    def on_iter_nth_child(self, parent, n):
+        if parent is None and n < self.num_rows():
+            return n
+        return None
+
+    def on_iter_parent(self, child):
+        return None
+
+class DomainListModel(LazyListModel):
+    """List of security domains, with rows built on demand from the policy"""
+    COLUMN_TYPES = (gobject.TYPE_STRING, gobject.TYPE_STRING, gobject.TYPE_INT, gobject.TYPE_INT)
+    # above this fraction of changed rows, it is faster to use a new model
+    MAX_CHANGES = 0.5
+
+    def __init__(self, policy, matches=None):
+        """Initializes the model for a TomoyoPolicy.
+
+        If matches is specified, only domains of this DomainIndex are displayed."""
+        LazyListModel.__init__(self)
+        self.policy = policy
+        self.matches = matches
+        self.domains = self.visible_domains()
+        # displayed domains, in the same order as self.domains once the model is synced
+        self.rows = list(self.domains)
+        self.state = (policy.policy, policy.policy_profile, policy.policy_tree)
+
+    def visible_domains(self):
+        """Returns index of domains which should be displayed"""
+        if self.matches is None:
+            return self.policy.policy
+        return self.matches
+
+    def domain_weight(self, profile):
+        """Returns font weight for a domain profile, which depends on whether it is active"""
+        if profile:
+            return pango.WEIGHT_BOLD
+        return pango.WEIGHT_NORMAL
+
+    def domain_values(self, domain, state):
+        """Returns (path, level, weight) for a domain from a given policy state"""
+        domains, domains_profile, domains_tree = state
+        path, level, end = domains_tree[domains.index(domain)]
+        return path, level, self.domain_weight(domains_profile[domain])
+
+    def values(self, domain):
+        """Returns (path, level, weight) for a displayed domain"""
+        if domain in self.policy.policy:
+            return self.domain_values(domain, (self.policy.policy, self.policy.policy_profile, self.policy.policy_tree))
+        # domain was removed from policy, but its row was not deleted yet
+        return self.domain_values(domain, self.state)
+
+    def sync(self, matches=None):
+        """Updates the rows after the policy was changed or reloaded.
+
+        Only the rows of domains which were added, removed or changed are touched,
+        so selection and scrolling are preserved. Returns False if the domains were
+        reordered or changed too much, in which case a new model should be used."""
+        self.matches = matches
+        domains = self.domains = self.visible_domains()
+        removed = [pos for pos in xrange(len(self.rows)) if self.rows[pos] not in domains]
+        num_changes = len(removed) + len(domains) - (len(self.rows) - len(removed))
+        if num_changes > self.MAX_CHANGES * max(len(domains), len(self.rows)):
+            return False
+        # remaining domains must keep their order
+        last = -1
+        for domain in self.rows:
+            if domain in domains:
+                pos = domains.index(domain)
+                if pos < last:
+                    return False
+                last = pos
+
+        # removed domains
+        removed.reverse()
+        for pos in removed:
+            del self.rows[pos]
+            self.row_deleted((pos,))
+
+        # added and changed domains
+        for pos, domain in enumerate(domains):
+            if pos < len(self.rows) and self.rows[pos] == domain:
+                if self.domain_values(domain, self.state) != self.values(domain):
+                    self.row_changed((pos,), self.get_iter((pos,)))
+                continue
+            self.rows.insert(pos, domain)
+            self.row_inserted((pos,), self.get_iter((pos,)))
+        self.state = (self.policy.policy, self.policy.policy_profile, self.policy.policy_tree)
+        return True
+
+    def update_domains(self, domains):
+        """Refreshes rows for domains which were changed in place"""
+        for domain in domains:
+            if domain not in self.domains:
+                continue
+            pos = self.domains.index(domain)
+            self.row_changed((pos,), self.get_iter((pos,)))
+
+    def num_rows(self):
+        return len(self.rows)
+
+    def on_get_value(self, rowref, column):
+        if rowref >= len(self.rows):
+            return None
+        domain = self.rows[rowref]
+        if column == TomoyoGui.COLUMN_DOMAIN:
+            return domain
+        path, level, weight = self.values(domain)
+        if column == TomoyoGui.COLUMN_PATH:
+            return path
+        elif column == TomoyoGui.COLUMN_WEIGHT:
+            return weight
+        return level
+
+class AclListModel(LazyListModel):
+    """List of ACL of a security domain, with rows built on demand"""
+    COLUMN_TYPES = (gobject.TYPE_STRING, gobject.TYPE_STRING)
+
+    def __init__(self, params):
+        """Initializes the model for a list of (acl, path) tuples"""
+        LazyListModel.__init__(self)
+        self.params = params
+
+    def num_rows(self):
+        return len(self.params)
+
+    def on_get_value(self, rowref, column):
+        if rowref >= len(self.params):
+            return None
+        acl, item = self.params[rowref]
+        if column == TomoyoGui.COLUMN_ACL_ITEM:
+            return item
+        return acl
+
 class TomoyoGui:
     (COLUMN_PATH, COLUMN_DOMAIN, COLUMN_WEIGHT, COLUMN_LEVEL) = range(4)
-    (COLUMN_EXCEPTION, COLUMN_TYPE) = range(2)
+    (COLUMN_EXCEPTION, COLUMN_TYPE, COLUMN_EXCEPTION_ID) = range(3)
+    (COLUMN_ACL_ITEM, COLUMN_ACL) = range(2)
     DOMAINS=[_("Disabled"), _("Learning"), _("Permissive"), _("Enforced")]
+    # number of domains listed when a group is selected
+    MAX_LISTED_DOMAINS=100
+    # import dialog response for unmerging a policy
+    RESPONSE_UNMERGE=1
 
     def __init__(self, policy, exceptions, embed=None, execution_path="/usr/share/tomoyo-mdv"):
         """Initializes main window and GUI"""
@@ -141,7 +394,7 @@ class TomoyoGui:
             self.window = gtk.Window()
             self.window.set_title(_("Tomoyo GUI"))
             self.window.set_default_size(640, 440)
-        self.window.connect('delete-event', lambda *w: gtk.main_quit())
+        self.window.connect('delete-event', lambda *w: not self.quit())
 
         self.policy = policy
         self.exceptions = exceptions
@@ -157,7 +410,7 @@ class TomoyoGui:
 
         toolbar_item = gtk.ToolButton("Refresh")
         toolbar_item.set_stock_id(gtk.STOCK_REFRESH)
-        toolbar_item.connect("clicked", lambda *w: self.refresh_domains(self.all_domains, self.active_domains, reload=True))
+        toolbar_item.connect("clicked", lambda *w: self.refresh_domains(reload=True))
         toolbar_item.set_tooltip_text(_("Refresh policy"))
         toolbar.insert(toolbar_item, -1)
 
@@ -193,6 +446,13 @@ class TomoyoGui:
         self.selected_domains = None
         toolbar.insert(self.import_domains, -1)
 
+        # policy compaction
+        toolbar_item = gtk.ToolButton("Compact")
+        toolbar_item.set_stock_id(gtk.STOCK_CLEAR)
+        toolbar_item.connect("clicked", self.compact_policy)
+        toolbar_item.set_tooltip_text(_("Remove redundant ACL entries"))
+        toolbar.insert(toolbar_item, -1)
+
         toolbar.insert(gtk.SeparatorToolItem(), -1)
 
         # policy initializing
@@ -207,12 +467,25 @@ class TomoyoGui:
 
         toolbar_item = gtk.ToolButton("Quit")
         toolbar_item.set_stock_id(gtk.STOCK_QUIT)
-        toolbar_item.connect("clicked", lambda *w: gtk.main_quit())
+        toolbar_item.connect("clicked", lambda *w: self.quit())
         toolbar_item.set_tooltip_text(_("Quit without saving"))
         toolbar.insert(toolbar_item, -1)
 
         self.main_vbox.pack_start(toolbar, False, False)
 
+        # domain filter
+        hbox = gtk.HBox(spacing=5)
+        hbox.pack_start(gtk.Label(_("Filter domains:")), False, False)
+        self.filter_entry = gtk.Entry()
+        self.filter_entry.set_tooltip_text(_("Only show domains containing this text"))
+        self.filter_entry.connect('changed', self.filter_changed)
+        hbox.pack_start(self.filter_entry)
+        self.main_vbox.pack_start(hbox, False, False)
+        self.filter_timeout = None
+        self.search_index = None
+        # (key, domains) of last type-ahead search
+        self.search_cache = None
+
         # tabs
         self.notebook = gtk.Notebook()
         self.main_vbox.pack_start(self.notebook)
@@ -221,6 +494,7 @@ class TomoyoGui:
         # domains
         sw_all, self.all_domains = self.build_list_of_domains()
         sw_active, self.active_domains = self.build_list_of_domains()
+        self.domains_model = None
 
         # help text for switching pages
         self.num_pages = 0
@@ -236,6 +510,8 @@ class TomoyoGui:
         sw2.set_shadow_type(gtk.SHADOW_ETCHED_IN)
         frame = gtk.Frame(_("Details"))
         self.domain_details = gtk.VBox(False, 5)
+        # domain whose ACL is shown in details
+        self.details_domain = None
         frame.add(self.domain_details)
         sw2.add_with_viewport(frame)
         self.main_vbox.pack_start(sw2)
@@ -246,20 +522,30 @@ class TomoyoGui:
         # show initial help
         self.show_help(0)
 
-        self.window.show_all()
-
-        self.refresh_domains(self.all_domains, self.active_domains)
-
         # now building exceptions
         sw_exceptions, self.ls_exceptions = self.build_list_of_exceptions()
-        self.update_exceptions()
         self.notebook.append_page(sw_exceptions, gtk.Label(_("Exceptions")))
         self.add_page_help("Exceptions")
 
+        # policy comparison
+        self.notebook.append_page(self.build_compare(), gtk.Label(_("Compare")))
+        self.add_page_help("Compare")
+
         # help
         self.notebook.append_page(self.build_help(), gtk.Label(_("Help")))
         self.add_page_help("Help")
 
+        # profiling results
+        if tomoyo_policy.PROFILER:
+            self.notebook.append_page(self.build_profiler(), gtk.Label(_("Profile")))
+            self.add_page_help("Profile")
+
+        self.window.show_all()
+
+        # policy is loaded in background
+        self.loader = None
+        self.refresh_domains()
+
     def add_page_help(self, page):
         """Associates tab number with contents"""
         self.page_help[self.num_pages] = page
@@ -284,7 +570,7 @@ class TomoyoGui:
                       buttons=(gtk.STOCK_CANCEL,gtk.RESPONSE_CANCEL,gtk.STOCK_SAVE,gtk.RESPONSE_OK))
         response = chooser.run()
         if response != gtk.RESPONSE_OK:
-            dialog.destroy()
+            chooser.destroy()
             return
         filename = chooser.get_filename()
         chooser.destroy()
@@ -305,14 +591,16 @@ class TomoyoGui:
         # confirming before importing
         dialog = gtk.Dialog(_("Importing policy"),
                 self.window, 0,
-                (gtk.STOCK_OK, gtk.RESPONSE_OK,
+                (_("Merge"), gtk.RESPONSE_OK,
+                _("Unmerge"), self.RESPONSE_UNMERGE,
                 gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL))
         dialog.set_default_size(600, 240)
         label = gtk.Label(_("Importing policy from %s"))
         dialog.vbox.pack_start(gtk.Label(_("Importing policy from %s") % filename), False, False)
         dialog.vbox.pack_start(gtk.HSeparator(), False, False)
         dialog.vbox.pack_start(gtk.Label(_("Number of entries in policy: %d") % len(domains)), False, False)
-        dialog.vbox.pack_start(gtk.Label(_("Number of entries which overwrite current policy: %d") % num_updates), False, False)
+        dialog.vbox.pack_start(gtk.Label(_("Number of entries already in current policy: %d") % num_updates), False, False)
+        dialog.vbox.pack_start(gtk.Label(_("Merging adds ACL of these entries to current policy, unmerging removes it.")), False, False)
         # showing policy content
         buffer = gtk.TextBuffer()
         buffer.set_text("\n".join(domains))
@@ -330,20 +618,83 @@ class TomoyoGui:
         dialog.show_all()
         response = dialog.run()
         dialog.destroy()
-        if response != gtk.RESPONSE_OK:
+        if response not in [gtk.RESPONSE_OK, self.RESPONSE_UNMERGE]:
             return
 
         # now really import
-        num_updates, domains = self.policy.import_policy(filename, merge=True)
-        # save and reload everything
-        self.save_domains()
-        self.refresh_domains(self.all_domains, self.active_domains, reload=True)
+        if response == self.RESPONSE_UNMERGE:
+            num_updates, domains = self.policy.import_policy(filename, unmerge=True)
+        else:
+            num_updates, domains = self.policy.import_policy(filename, merge=True)
+        self.refresh_domains(reload=False)
+        # ACL rows shown in details refer to the previous ACL
+        self.refresh_domain_details()
+        # save and apply the changes, as reloading would replace them by kernel policy
+        self.save_domains(reload=True)
+
+    def compact_policy(self, widget):
+        """Removes redundant ACL entries from policy"""
+        with profile("compact domains"):
+            compacted = self.policy.compact(self.exceptions)
+        if not compacted:
+            dialog = gtk.MessageDialog(
+                    parent=self.window,
+                    flags=0,
+                    type=gtk.MESSAGE_INFO,
+                    message_format = _("No redundant ACL entries were found in policy."),
+                    buttons=gtk.BUTTONS_OK
+                    )
+            dialog.show_all()
+            dialog.run()
+            dialog.destroy()
+            return
+        # confirming before compacting
+        dialog = gtk.Dialog(_("Compacting policy"),
+                self.window, 0,
+                (gtk.STOCK_OK, gtk.RESPONSE_OK,
+                gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL))
+        dialog.set_default_size(600, 240)
+        removed = sum([duplicates + collapsed + granted for domain, acl, duplicates, collapsed, granted, saved in compacted])
+        total_saved = sum([item[5] for item in compacted])
+        dialog.vbox.pack_start(gtk.Label(_("Number of compacted domains: %d") % len(compacted)), False, False)
+        dialog.vbox.pack_start(gtk.Label(_("Number of removed entries: %d (%d bytes)") % (removed, total_saved)), False, False)
+        # showing savings of each domain
+        lines = []
+        for domain, acl, duplicates, collapsed, granted, saved in compacted:
+            lines.append(domain)
+            lines.append(_("    %d duplicated, %d covered by file_pattern, %d granted by allow_read, %d bytes saved") % (duplicates, collapsed, granted, saved))
+        buffer = gtk.TextBuffer()
+        buffer.set_text("\n".join(lines))
+        sw = gtk.ScrolledWindow()
+        sw.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+        sw.set_shadow_type(gtk.SHADOW_ETCHED_IN)
+        frame = gtk.Frame(_("Savings of each domain:"))
+        label = gtk.TextView(buffer)
+        label.set_wrap_mode(gtk.WRAP_WORD_CHAR)
+        label.set_editable(False)
+        sw.add_with_viewport(label)
+        frame.add(sw)
+        dialog.vbox.pack_start(frame)
+
+        dialog.show_all()
+        response = dialog.run()
+        dialog.destroy()
+        if response != gtk.RESPONSE_OK:
+            return
 
+        # now really compact, and save the smaller policy
+        self.policy.apply_compaction(compacted)
+        self.save_domains()
+        self.refresh_domains(reload=False)
+        # ACL rows shown in details refer to the previous ACL
+        self.refresh_domain_details()
 
     def show_help_for_page(self, notebook, page, page_num):
         """Shows help for current page"""
         if page_num in self.page_help:
             self.show_help(page_num)
+            if self.page_help[page_num] == "Profile":
+                self.update_profiler()
 
     def show_help(self, page):
         """Shows initial help text"""
@@ -358,6 +709,12 @@ class TomoyoGui:
         elif tab == "Exceptions":
             title = tab
             help = HELP_EXCEPTIONS
+        elif tab == "Compare":
+            title = tab
+            help = HELP_COMPARE
+        elif tab == "Profile":
+            title = tab
+            help = HELP_PROFILE
         elif tab == "Help":
             # default help text
             title = _("Help for TOMOYO Linux gui")
@@ -379,109 +736,233 @@ class TomoyoGui:
         else:
             return None
 
-    def save_domains(self, reload=False):
-        """Saves and, optionally, reload current policy"""
-        # saving exceptions
-        ret = self.exceptions.save()
-        # saving policy
-        ret = self.policy.save(reload)
-        if not ret:
+    def quit(self):
+        """Leaves the application, asking for confirmation if there are unsaved changes"""
+        if self.policy.is_modified() or self.exceptions.is_modified():
             dialog = gtk.MessageDialog(
                     parent=self.window,
                     flags=0,
-                    type=gtk.MESSAGE_ERROR,
-                    message_format = _("Unable to save TOMOYO policy! Please certify that tomoyo-tools package is installed and operational."),
-                    buttons=gtk.BUTTONS_OK
-                    )
+                    type=gtk.MESSAGE_QUESTION,
+                    message_format = _("There are unsaved changes to TOMOYO policy. Do you really want to quit without saving them?"),
+                    buttons=gtk.BUTTONS_YES_NO)
             dialog.show_all()
-            dialog.run()
+            ret = dialog.run()
             dialog.destroy()
+            if ret != gtk.RESPONSE_YES:
+                return False
+        gtk.main_quit()
+        return True
 
+    def save_domains(self, reload=False):
+        """Saves and, optionally, reload current policy"""
+        # only changed parts of the policy are saved and reloaded
+        # saving exceptions
+        ret = self.exceptions.save(reload)
+        # saving policy
+        ret = self.policy.save(reload) and ret
+        if not ret:
+            errors = [error for error in [self.policy.error, self.exceptions.error] if error]
+            self.show_errors(_("Unable to save TOMOYO policy! Please certify that tomoyo-tools package is installed and operational."), errors)
 
-    def refresh_domains(self, lstore_all, lstore_active, reload=True):
+    def show_errors(self, text, errors):
+        """Shows an error message, with errors reported by policy tools"""
+        dialog = gtk.MessageDialog(
+                parent=self.window,
+                flags=0,
+                type=gtk.MESSAGE_ERROR,
+                message_format = text,
+                buttons=gtk.BUTTONS_OK
+                )
+        if errors:
+            dialog.format_secondary_text("\n".join(errors))
+        dialog.show_all()
+        dialog.run()
+        dialog.destroy()
+
+
+    def refresh_domains(self, reload=True):
         """Refresh the list of domain entries"""
         # building the list of domains and active domains
 
-        # reload policy from disk?
+        # reload policy from disk? the lists are refreshed when loading finishes
         if reload:
-            # show some informative window
-            progress = gtk.Window()
-            progress.set_title(_("Please wait..."))
-            progress.set_transient_for(self.window)
-            progress.set_modal(True)
-            progress.connect('delete-event', lambda *w: None)
-
-            vbox = gtk.VBox(spacing=10)
-            progress.add(vbox)
-            vbox.add(gtk.Label("Please wait, loading TOMOYO policy..."))
-
-            # show window
-            progress.show_all()
-            self.process_events()
+            self.load_policy()
+            return
 
-            # reload policy
-            ret = self.policy.reload()
+        with profile("populate domains"):
+            # search index is built again when needed
+            self.search_index = None
+            matches = self.search_domains(self.filter_entry.get_text())
 
-            # reload exceptions
-            ret = self.exceptions.reload()
+            # only update changed rows when possible
+            if self.domains_model and self.domains_model.sync(matches):
+                return
 
-            # kill progress window
-            progress.destroy()
+            self.show_domains(matches)
 
-            if not ret:
-                # something went wrong..
-                dialog = gtk.MessageDialog(
-                        parent=self.window,
-                        flags=0,
-                        type=gtk.MESSAGE_ERROR,
-                        message_format = _("TOMOYO policy not found or not initialized. Do you want to initialize the default TOMOYO policy?"),
-                        buttons=gtk.BUTTONS_YES_NO)
-                dialog.show_all()
-                ret = dialog.run()
+    def show_domains(self, matches):
+        """Builds domain lists, with only given domains if matches is not None"""
+        # rows are served directly from the policy, and active domains are filtered from it
+        self.domains_model = DomainListModel(self.policy, matches)
+        active_model = self.domains_model.filter_new()
+        active_model.set_visible_func(lambda model, iter:
+                model.get_value(iter, self.COLUMN_WEIGHT) == pango.WEIGHT_BOLD)
 
-                dialog.destroy()
-                if ret == gtk.RESPONSE_YES:
-                    # installing policy
-                    self.install_policy(confirm=False)
+        self.all_domains.set_model(self.domains_model)
+        self.active_domains.set_model(active_model)
 
+    def search_domains(self, key):
+        """Returns index of domains which contain key, or None if key is empty"""
+        if not key:
+            return None
+        if not self.search_index:
+            self.search_index = DomainSearchIndex(self.policy.policy)
+            self.search_cache = None
+        return DomainIndex(self.search_index.search(key))
+
+    def search_matches(self, key):
+        """Returns set of domains which contain key, computed once for each searched key"""
+        if not self.search_index:
+            self.search_index = DomainSearchIndex(self.policy.policy)
+            self.search_cache = None
+        if not self.search_cache or self.search_cache[0] != key:
+            self.search_cache = (key, set(self.search_index.search(key)))
+        return self.search_cache[1]
+
+    def filter_changed(self, entry):
+        """Domain filter was changed, applying it after user stops typing"""
+        if self.filter_timeout:
+            gobject.source_remove(self.filter_timeout)
+        self.filter_timeout = gobject.timeout_add(250, self.apply_filter)
+
+    def apply_filter(self):
+        """Filters the domain lists"""
+        self.filter_timeout = None
+        with profile("filter domains"):
+            self.show_domains(self.search_domains(self.filter_entry.get_text()))
+        return False
+
+    def load_policy(self):
+        """Loads policy and exceptions in background"""
+        if self.loader:
+            # already loading
+            return
+        # show some informative window
+        progress = gtk.Window()
+        progress.set_title(_("Please wait..."))
+        progress.set_transient_for(self.window)
+        progress.set_modal(True)
+        progress.set_default_size(400, -1)
 
-        lstore_all.clear()
-        lstore_active.clear()
+        vbox = gtk.VBox(spacing=10)
+        vbox.set_border_width(10)
+        progress.add(vbox)
+        vbox.pack_start(gtk.Label(_("Please wait, loading TOMOYO policy...")))
+        self.progressbar = gtk.ProgressBar()
+        self.progressbar.set_text(_("Saving current kernel policy..."))
+        vbox.pack_start(self.progressbar)
+
+        buttons = gtk.HButtonBox()
+        buttons.set_layout(gtk.BUTTONBOX_END)
+        cancel = gtk.Button(stock=gtk.STOCK_CANCEL)
+        cancel.connect('clicked', lambda *w: self.loader.cancel())
+        buttons.pack_start(cancel)
+        vbox.pack_start(buttons, False, False)
+        progress.connect('delete-event', lambda *w: self.loader.cancel() or True)
 
-        def add_to_liststore(lstore, path, item, color, level):
-            iter = lstore.append()
-            lstore.set(iter,
-                    self.COLUMN_PATH, path,
-                    self.COLUMN_DOMAIN, item,
-                    self.COLUMN_WEIGHT, color,
-                    self.COLUMN_LEVEL, level)
-
-        for i in range(len(self.policy.policy)):
-            # quick and dirty way to find out if domain is active
-            item = self.policy.policy[i]
-            path, level = self.policy.policy_tree[i]
-            dom, val = self.policy.policy_dict[item][0]
-            if val == "0":
-                color = pango.WEIGHT_NORMAL
-            else:
-                color = pango.WEIGHT_BOLD
-                add_to_liststore(lstore_active, path, item, color, level)
-            add_to_liststore(lstore_all, path, item, color, level)
+        # show window
+        progress.show_all()
+        self.progress_window = progress
+
+        self.loader = TomoyoLoader(self.policy, self.exceptions,
+                progress=self.update_load_progress,
+                finished=self.finish_load_policy)
+        self.loader.start()
+
+    def update_load_progress(self, text, fraction):
+        """Updates policy loading progress"""
+        if not self.loader:
+            # loading has already finished
+            return False
+        self.progressbar.set_text(text)
+        if fraction < 0:
+            self.progressbar.pulse()
+        else:
+            self.progressbar.set_fraction(fraction)
+        return False
+
+    def finish_load_policy(self, result):
+        """Policy loading has finished"""
+        self.loader.join()
+        error = self.loader.error
+        self.loader = None
+        # kill progress window
+        self.progress_window.destroy()
+        self.progress_window = None
+
+        if not result:
+            # loading was cancelled or failed, keeping current policy
+            if error:
+                self.show_errors(_("Unable to load TOMOYO policy, displayed policy might be outdated."), [error])
+            return False
+
+        policy, exceptions = result
+        # reload policy
+        ret = self.policy.update(policy)
+
+        # reload exceptions
+        ret = self.exceptions.update(exceptions) and ret
+
+        errors = [error for error in [self.policy.error, self.exceptions.error] if error]
+        if ret and errors:
+            # kernel policy could not be saved, showing what was loaded from disk
+            self.show_errors(_("Unable to save current TOMOYO kernel policy, displayed policy might be outdated."), errors)
+
+        if not ret:
+            # something went wrong..
+            dialog = gtk.MessageDialog(
+                    parent=self.window,
+                    flags=0,
+                    type=gtk.MESSAGE_ERROR,
+                    message_format = _("TOMOYO policy not found or not initialized. Do you want to initialize the default TOMOYO policy?"),
+                    buttons=gtk.BUTTONS_YES_NO)
+            dialog.show_all()
+            ret = dialog.run()
+
+            dialog.destroy()
+            if ret == gtk.RESPONSE_YES:
+                # installing policy
+                self.install_policy(confirm=False)
+
+        self.refresh_domains(reload=False)
+        # selected domain is kept, but its ACL was loaded again
+        self.refresh_domain_details()
+        self.update_exceptions()
+        return False
 
     def update_exceptions(self):
         """Updates the list of exceptions"""
-        def add_to_liststore(lstore, item, type):
+        def add_to_liststore(lstore, id, item, type):
             iter = lstore.append()
             lstore.set(iter,
                     self.COLUMN_EXCEPTION, item,
                     self.COLUMN_TYPE, type,
+                    self.COLUMN_EXCEPTION_ID, id,
                     )
 
-        for exc in self.ls_exceptions:
-            lstore = self.ls_exceptions[exc]
-            lstore.clear()
-            for item in self.exceptions.exceptions[exc]:
-                add_to_liststore(lstore, item, exc)
+        for exc in self.exceptions.exceptions:
+            if exc not in self.ls_exceptions:
+                # exception type not known in advance
+                self.add_exceptions_class(exc)
+
+        with profile("populate exceptions"):
+            for exc in self.ls_exceptions:
+                lstore = self.ls_exceptions[exc]
+                lstore.clear()
+                if exc not in self.exceptions.exceptions:
+                    continue
+                for id, item in self.exceptions.exceptions[exc].items():
+                    add_to_liststore(lstore, id, item, exc)
 
     def process_events(self):
         """Process pending gtk events"""
@@ -563,20 +1044,25 @@ class TomoyoGui:
     def build_list_of_exceptions(self):
         """Builds scrollable list of exceptions"""
         # tabs
-        exceptions = {}
+        self.ls_exceptions = {}
         vbox = gtk.VBox()
-        notebook = gtk.Notebook()
-        notebook.set_scrollable(True)
-        vbox.pack_start(notebook)
+        self.exceptions_notebook = gtk.Notebook()
+        self.exceptions_notebook.set_scrollable(True)
+        vbox.pack_start(self.exceptions_notebook)
 
         classes = self.exceptions.exceptions.keys()
         classes.sort()
         for item in classes:
-            sw_exceptions, exceptions_list = self.build_exceptions_for_class(item)
-            notebook.append_page(sw_exceptions, gtk.Label(item))
-            exceptions[item] = exceptions_list
+            self.add_exceptions_class(item)
         vbox.show_all()
-        return vbox, exceptions
+        return vbox, self.ls_exceptions
+
+    def add_exceptions_class(self, item):
+        """Adds a tab for exceptions of given type"""
+        sw_exceptions, exceptions_list = self.build_exceptions_for_class(item)
+        sw_exceptions.show_all()
+        self.exceptions_notebook.append_page(sw_exceptions, gtk.Label(item))
+        self.ls_exceptions[item] = exceptions_list
 
     def build_help(self):
         """Build help screen"""
@@ -593,6 +1079,97 @@ class TomoyoGui:
         vbox.show_all()
         return vbox
 
+    def build_compare(self):
+        """Builds policy comparison view"""
+        vbox = gtk.VBox(spacing=5)
+        hbox = gtk.HBox(spacing=5)
+        hbox.pack_start(gtk.Label(_("Compare current policy with:")), False, False)
+        self.compare_source = gtk.combo_box_new_text()
+        for source in [_("Kernel policy"), _("System policy"), _("Policy file...")]:
+            self.compare_source.append_text(source)
+        self.compare_source.set_active(0)
+        hbox.pack_start(self.compare_source, False, False)
+        button = gtk.Button(_("Compare"))
+        button.connect('clicked', lambda *w: self.compare_policy())
+        hbox.pack_start(button, False, False)
+        self.compare_summary = gtk.Label()
+        hbox.pack_start(self.compare_summary, False, False)
+        vbox.pack_start(hbox, False, False)
+
+        sw = gtk.ScrolledWindow()
+        sw.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+        sw.set_shadow_type(gtk.SHADOW_ETCHED_IN)
+        self.compare_buffer = gtk.TextBuffer()
+        view = gtk.TextView(self.compare_buffer)
+        view.set_editable(False)
+        view.modify_font(pango.FontDescription("monospace"))
+        sw.add(view)
+        vbox.pack_start(sw)
+        vbox.show_all()
+        return vbox
+
+    def compare_policy(self):
+        """Shows differences between selected policy and the current one"""
+        source = ["kernel", "system", None][self.compare_source.get_active()]
+        if source is None:
+            chooser = gtk.FileChooserDialog(title=_("Policy comparison"),action=gtk.FILE_CHOOSER_ACTION_OPEN,
+                          buttons=(gtk.STOCK_CANCEL,gtk.RESPONSE_CANCEL,gtk.STOCK_OPEN,gtk.RESPONSE_OK))
+            response = chooser.run()
+            source = chooser.get_filename()
+            chooser.destroy()
+            if response != gtk.RESPONSE_OK:
+                return
+        old = open_policy(source, securityfs=self.policy.securityfs, version=self.policy.version,
+                cache=self.policy.cache, jobs=self.policy.jobs)
+        if not old.update(old.load()):
+            self.show_errors(_("Unable to load TOMOYO policy from %s!") % old.location, [])
+            return
+        with profile("compare domains"):
+            diff = PolicyDiff(old, self.policy)
+        self.compare_summary.set_text(_("%d domains added, %d removed, %d changed, %d ACL entries added, %d removed") % (diff.added,
+                diff.removed, diff.changed, diff.added_acl, diff.removed_acl))
+        self.compare_buffer.set_text("".join(diff.format()))
+
+    def build_profiler(self):
+        """Builds list of profiling results"""
+        vbox = gtk.VBox(spacing=5)
+        sw = gtk.ScrolledWindow()
+        sw.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+        sw.set_shadow_type(gtk.SHADOW_ETCHED_IN)
+        vbox.pack_start(sw)
+
+        self.ls_profiler = gtk.ListStore(
+            gobject.TYPE_STRING,
+            gobject.TYPE_INT,
+            gobject.TYPE_STRING,
+            gobject.TYPE_STRING,
+            gobject.TYPE_INT,
+            gobject.TYPE_INT,
+            )
+        treeview = gtk.TreeView(self.ls_profiler)
+        treeview.set_rules_hint(True)
+        for pos, title in enumerate([_("Phase"), _("Runs"), _("Time (s)"), _("Longest (s)"), _("Objects"), _("Peak (KB)")]):
+            column = gtk.TreeViewColumn(title, gtk.CellRendererText(), text=pos)
+            column.set_resizable(True)
+            treeview.append_column(column)
+        sw.add(treeview)
+
+        buttons = gtk.HButtonBox()
+        buttons.set_layout(gtk.BUTTONBOX_END)
+        refresh = gtk.Button(stock=gtk.STOCK_REFRESH)
+        refresh.connect('clicked', lambda *w: self.update_profiler())
+        buttons.pack_start(refresh)
+        vbox.pack_start(buttons, False, False)
+        vbox.show_all()
+        return vbox
+
+    def update_profiler(self):
+        """Updates the list of profiling results"""
+        self.ls_profiler.clear()
+        for name, phase in tomoyo_policy.PROFILER.report():
+            self.ls_profiler.append((name, phase["runs"], "%.3f" % phase["time"],
+                "%.3f" % phase["max_time"], phase["objects"], phase["maxrss"]))
+
     def build_exceptions_for_class(self, item):
         """Builds list of exceptions of given type"""
         # scrolled window
@@ -604,6 +1181,7 @@ class TomoyoGui:
         lstore = gtk.ListStore(
             gobject.TYPE_STRING,
             gobject.TYPE_STRING,
+            gobject.TYPE_INT,
             )
 
         # treeview
@@ -645,19 +1223,14 @@ class TomoyoGui:
         sw.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
         sw.set_shadow_type(gtk.SHADOW_ETCHED_IN)
 
-        # list of options
-        lstore = gtk.ListStore(
-            gobject.TYPE_STRING,
-            gobject.TYPE_STRING,
-            gobject.TYPE_INT,
-            gobject.TYPE_INT)
-
-        # treeview
-        treeview = gtk.TreeView(lstore)
+        # treeview, its model is set when policy is loaded
+        treeview = gtk.TreeView()
         treeview.set_rules_hint(True)
         treeview.set_search_column(self.COLUMN_PATH)
+        # only render visible rows
+        treeview.set_fixed_height_mode(True)
 
-        treeview.connect('row-activated', self.expand_domain, lstore)
+        treeview.connect('row-activated', self.expand_domain)
 
         # selection
         selection = treeview.get_selection()
@@ -670,6 +1243,8 @@ class TomoyoGui:
         renderer = gtk.CellRendererText()
         renderer.set_property('width', 400)
         column = gtk.TreeViewColumn(_('Security domain'), renderer, text=self.COLUMN_PATH, weight=self.COLUMN_WEIGHT)
+        column.set_sizing(gtk.TREE_VIEW_COLUMN_FIXED)
+        column.set_fixed_width(400)
         column.set_resizable(True)
         column.set_expand(True)
         treeview.append_column(column)
@@ -678,11 +1253,12 @@ class TomoyoGui:
 
         # search
         def search_domain(model, column, key, iter, data=None):
-            path = model.get_value(iter, self.COLUMN_PATH)
-            return path.find(key) < 0
+            domain = model.get_value(iter, self.COLUMN_DOMAIN)
+            # called for each row, so matches are only searched when key changes
+            return domain not in self.search_matches(key)
         treeview.set_search_equal_func(func=search_domain)
 
-        return sw, lstore
+        return sw, treeview
 
     def build_profile(self, profile, domains):
         """Building profile selection combobox"""
@@ -699,13 +1275,8 @@ class TomoyoGui:
     def change_profile(self, cur_profile, domains):
         """Change profile for domains"""
         new_profile = cur_profile.get_active()
-        for domain in domains:
-            params = self.policy.policy_dict.get(domain)
-            for i in range(len(params)):
-                p, val = params[i]
-                if p == 'use_profile':
-                    params[i] = (p, new_profile)
-                    break
+        self.policy.set_profile(domains, new_profile)
+        self.domains_model.update_domains(domains)
 
     def __add_row(self, table, row, label_text, options=None, markup=False, wrap=False, entry=None, type="domain"):
         label = gtk.Label()
@@ -777,7 +1348,7 @@ class TomoyoGui:
 
     def edit_exception(self, menuitem, entry):
         """An entry will be changed"""
-        type, pos, item = entry
+        type, id, item = entry
         if DEBUG:
             print "Editing %s [%s]:" % (item, type)
         dialog = gtk.Dialog(_("Editing exception"),
@@ -809,20 +1380,20 @@ class TomoyoGui:
         new_item = entry_path.get_text()
         dialog.destroy()
 
-        self.exceptions.exceptions[type][pos] = new_item
+        self.exceptions.update_exception(type, id, new_item)
 
         if DEBUG:
-            print "%s -> %s, %s -> %s" % (item, acl, new_item, new_acl)
+            print "%s -> %s" % (item, new_item)
 
         # refresh domain data
         self.update_exceptions()
 
     def delete_exception(self, menuitem, entry):
         """An entry will be deleted"""
-        type, pos, item = entry
+        type, id, item = entry
         if DEBUG:
             print "Deleting %s [%s]:" % (item, type)
-        del self.exceptions.exceptions[type][pos]
+        self.exceptions.delete_exception(type, id)
         # refresh exceptions data
         self.update_exceptions()
 
@@ -872,44 +1443,30 @@ class TomoyoGui:
         new_acl = entry_acl.get_text()
         dialog.destroy()
 
-        params[pos] = (new_acl, new_item)
+        self.policy.update_acl(domain, pos, new_acl, new_item)
         if DEBUG:
             print "%s -> %s, %s -> %s" % (item, acl, new_item, new_acl)
 
         # refresh domain data
-        self.show_domain_details(domain)
+        self.acl_model.row_changed((pos,), self.acl_model.get_iter((pos,)))
 
     def delete_acl(self, menuitem, entry):
         """An entry will be deleted"""
         domain, pos, item = entry
         if DEBUG:
             print "Deleting %s [%s]:" % (domain, item)
-        params = self.policy.policy_dict.get(domain)
-        del params[pos]
+        self.policy.delete_acl(domain, pos)
         # refresh domain data
-        self.show_domain_details(domain)
+        if self.policy.policy_dict[domain]:
+            self.acl_model.row_deleted((pos,))
+        else:
+            self.show_domain_details(domain)
 
     def entry_clicked(self, button, entry):
         """An ACL entry was clicked"""
         if DEBUG:
             print "Clicked on %s" % str(entry)
 
-    def format_acl(self, item):
-        """Format acl results"""
-        # TODO: we could rearrange the list of entries so use_profile comes always first,
-        # and include the policy level into the dict as well. This would get rid of
-        # policy_tree structure
-        params = self.policy.policy_dict.get(item, None)
-        profile = 0
-        acl = []
-        for i in range(len(params)):
-            p,val = params[i]
-            if p == 'use_profile':
-                profile = int(val)
-                continue
-            acl.append((i, p, val))
-        return profile, acl
-
     def select_domain(self, selection):
         """A domain is selected"""
         self.selected_domains = None
@@ -940,7 +1497,7 @@ class TomoyoGui:
             # building details
 
             # get profile description
-            profile, acl = self.format_acl(domains[0])
+            profile = self.policy.policy_profile.get(domains[0], 0)
             self.__add_row(table, cur_row, _("Profile"), options=self.build_profile(profile, domains))
             cur_row += 1
 
@@ -948,9 +1505,12 @@ class TomoyoGui:
             if len(domains) > 0:
                 self.__add_row(table, cur_row, _("<b>Sub-domains</b>"), markup=True)
                 cur_row += 1
-                for domain in domains:
+                for domain in domains[:self.MAX_LISTED_DOMAINS]:
                     self.__add_row(table, cur_row, domain)
                     cur_row += 1
+                if len(domains) > self.MAX_LISTED_DOMAINS:
+                    self.__add_row(table, cur_row, _("<i>... and %d more</i>") % (len(domains) - self.MAX_LISTED_DOMAINS), markup=True)
+                    cur_row += 1
 
             self.domain_details.show_all()
 
@@ -965,11 +1525,10 @@ class TomoyoGui:
         iter = model.get_iter(rows[0])
         exception = model.get_value(iter, self.COLUMN_EXCEPTION)
         type = model.get_value(iter, self.COLUMN_TYPE)
+        id = model.get_value(iter, self.COLUMN_EXCEPTION_ID)
         table, cur_row = self.refresh_details(self.domain_details, _("Exception details"))
         # building details
 
-        pos = self.exceptions.exceptions[type].index(exception)
-
         self.__add_row(table, cur_row, _("<b>%s</b>") % type, markup=True)
         cur_row += 1
         help = self.format_exception_help(type)
@@ -977,7 +1536,7 @@ class TomoyoGui:
             for line in help:
                 self.__add_row(table, cur_row, line, markup=True)
                 cur_row += 1
-        self.__add_row(table, cur_row, exception, type="exception", entry=(type, pos, exception))
+        self.__add_row(table, cur_row, exception, type="exception", entry=(type, id, exception))
         cur_row += 1
 
         self.domain_details.show_all()
@@ -986,6 +1545,7 @@ class TomoyoGui:
 
     def refresh_details(self, container, title):
         """Updates description of a domain or group of domains"""
+        self.details_domain = None
         children = container.get_children()
         for child in children:
             container.remove(child)
@@ -1007,46 +1567,106 @@ class TomoyoGui:
 
     def show_domain_details(self, domain):
         """Displays domain details"""
+        with profile("details"):
+            self.build_domain_details(domain)
+
+    def build_domain_details(self, domain):
+        """Builds domain details"""
         params = self.policy.policy_dict[domain]
 
         table, cur_row = self.refresh_details(self.domain_details, _("Configure ACL for %s") % domain)
 
         # get profile description
-        profile, acl = self.format_acl(domain)
+        profile = self.policy.policy_profile.get(domain, 0)
         self.__add_row(table, cur_row, _("Profile"), options=self.build_profile(profile, [domain]))
         cur_row += 1
 
         # building ACL
-        if len(acl) > 0:
+        self.acl_model = None
+        if len(params) > 0:
             self.__add_row(table, cur_row, _("<b>Security settings</b>"), markup=True)
             cur_row += 1
-            for pos, acl, item in acl:
-                self.__add_row(table, cur_row, item, options=gtk.Label(acl), entry = (domain, pos, item))
-                cur_row += 1
+            self.acl_model = AclListModel(params)
+            self.domain_details.pack_start(self.build_list_of_acl(domain, self.acl_model))
 
         self.domain_details.show_all()
+        self.details_domain = domain
+
+    def refresh_domain_details(self):
+        """Shows details of the displayed domain again, after its ACL was replaced"""
+        domain = self.details_domain
+        if domain is None:
+            return
+        if domain in self.policy.policy:
+            self.show_domain_details(domain)
+        else:
+            self.show_help(0)
+
+    def build_list_of_acl(self, domain, model):
+        """Builds scrollable list of domain ACL"""
+        sw = gtk.ScrolledWindow()
+        sw.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+        sw.set_shadow_type(gtk.SHADOW_ETCHED_IN)
+
+        treeview = gtk.TreeView(model)
+        treeview.set_rules_hint(True)
+        treeview.set_search_column(self.COLUMN_ACL_ITEM)
+        # only render visible rows
+        treeview.set_fixed_height_mode(True)
+        treeview.get_selection().set_mode(gtk.SELECTION_SINGLE)
+
+        treeview.connect('row-activated', self.activate_acl_entry, domain)
+        treeview.connect('button-press-event', self.click_acl_entry, domain)
+
+        for title, col, width in [(_('Path'), self.COLUMN_ACL_ITEM, 400), (_('ACL'), self.COLUMN_ACL, 150)]:
+            renderer = gtk.CellRendererText()
+            column = gtk.TreeViewColumn(title, renderer, text=col)
+            column.set_sizing(gtk.TREE_VIEW_COLUMN_FIXED)
+            column.set_fixed_width(width)
+            column.set_resizable(True)
+            column.set_expand(col == self.COLUMN_ACL_ITEM)
+            treeview.append_column(column)
+
+        sw.add(treeview)
+        return sw
 
-    def expand_domain(self, treeview, path, col, model):
+    def acl_entry(self, domain, path):
+        """Returns (domain, pos, item) entry for an ACL row"""
+        pos = path[0]
+        acl, item = self.policy.policy_dict[domain][pos]
+        return domain, pos, item
+
+    def activate_acl_entry(self, treeview, path, col, domain):
+        """An ACL entry was double-clicked"""
+        self.edit_acl(None, self.acl_entry(domain, path))
+
+    def click_acl_entry(self, treeview, event, domain):
+        """Shows editing menu for clicked ACL entry"""
+        if event.button != 3:
+            return False
+        pathinfo = treeview.get_path_at_pos(int(event.x), int(event.y))
+        if not pathinfo:
+            return False
+        path = pathinfo[0]
+        treeview.get_selection().select_path(path)
+        self.edit_acl_entry(treeview, event, self.acl_entry(domain, path), None)
+        return True
+
+    def expand_domain(self, treeview, path, col):
         """Locates all subdomains for a domain"""
-        start_path = path
+        model = treeview.get_model()
         if DEBUG:
             print "Expanding %s" % str(path)
-        iter = model.get_iter(path)
-        initial_level = model.get_value(iter, self.COLUMN_LEVEL)
-        domains = []
-        last_iter = iter
-        # detecting all subdomains
-        while True:
-            iter = model.iter_next(iter)
-            if not iter:
-                break
-            domain = model.get_value(iter, self.COLUMN_DOMAIN)
-            cur_level = model.get_value(iter, self.COLUMN_LEVEL)
-            domains.append(domain)
-            if cur_level <= initial_level:
+        domain = model.get_value(model.get_iter(path), self.COLUMN_DOMAIN)
+        subdomains = self.policy.subdomains(domain)
+
+        # first and last subdomains displayed in this view
+        start_path = path
+        end_path = None
+        for subdomain in reversed(subdomains):
+            end_path = self.domain_path(model, subdomain)
+            if end_path:
                 break
-            last_iter = iter
-        end_path = model.get_path(last_iter)
 
         # update selection
         selection = treeview.get_selection()
@@ -1057,232 +1677,17 @@ class TomoyoGui:
         # show details for the selected domains
         self.select_domain(selection)
 
+    def domain_path(self, model, domain):
+        """Returns path of a domain in a domain list, or None if it is not displayed"""
+        if isinstance(model, gtk.TreeModelFilter):
+            path = self.domain_path(model.get_model(), domain)
+            if path is None:
+                return None
+            return model.convert_child_path_to_path(path)
+        if domain not in model.domains:
+            return None
+        return (model.domains.index(domain),)
 
-class TomoyoPolicy:
-    POLICY_LOAD="/usr/sbin/tomoyo-loadpolicy fsd"
-    POLICY_SAVE="/usr/sbin/tomoyo-savepolicy fsd"
-    def __init__(self, policy="system", version="tomoyo"):
-        """Initializes the policy class.
-
-        If version is "tomoyo", LSM version of tomoyo is used.
-        Otherwise, if policy is "ccs", Tomoyo 1.6 policy is used.
-
-        If policy=system, reads policy from /etc/(tomoyo,ccs)/domain_policy.conf.
-        If policy=kernel, policy is read from /sys/kernel/security/tomoyo/domain_policy"""
-        self.policy = policy
-        self.version = version
-        if policy == "kernel":
-            self.location = "/sys/kernel/security/tomoyo/domain_policy"
-        else:
-            self.location = "/etc/%s/domain_policy.conf" % version
-        self.save_location = "domain_policy.conf"
-
-    def reload(self):
-        """Reloads the policy. If using system policy, current kernel policy is saved first"""
-        if self.policy == "system":
-            os.system(self.POLICY_SAVE)
-        success, self.policy, self.policy_dict, self.policy_tree = self.read_policy(self.location)
-        return success
-
-    def read_policy(self, location):
-        """Reads a policy from file"""
-        success = True
-        try:
-            with open(location) as fd:
-                data = fd.readlines()
-        except:
-            # unable to open policy file
-            print >>sys.stderr, "Unable to open policy file: %s" % self.location
-            data = []
-            success = False
-        # read domains
-        domains = []
-        domains_dict = {}
-        domains_tree = []
-        path = []
-        for line in data:
-            line = line.strip()
-            if not line:
-                continue
-            # parse domains
-            if line.find('<kernel>') == 0:
-                # it is a security domain
-                domain = line
-                domains.append(domain)
-                if domain not in domains_dict:
-                    domains_dict[domain] = []
-                items = line.split(" ")
-                depth = len(items)
-                last_depth = len(path) -1
-                if depth >= last_depth:
-                    del path[depth:]
-                curitems = []
-                curlevel = 0
-                # rebuilt item description
-                for i in range(depth):
-                    if i > last_depth:
-                        path += items[i:]
-                        curitems += items[i:]
-                        break
-                    if items[i] == path[i]:
-                        curitems.append("  ")
-                        curlevel += 1
-                        continue
-                    curitems.append(items[i])
-                    path[i] = items[i]
-                curpath = " ".join(curitems)
-                domains_tree.append((curpath, curlevel))
-            else:
-                # an ACL
-                try:
-                    command, params = line.split(" ", 1)
-                    domains_dict[domain].append((command, params))
-                except:
-                    # syntax error?
-                    success = False
-                    break
-        return success, domains, domains_dict, domains_tree
-
-    def import_policy(self, location, merge=False):
-        """Imports part of policy. If merge=True, merges imported policy into the system one."""
-        try:
-            if DEBUG:
-                print "Importing from %s" % location
-            success, domains, domains_dict, domains_tree = self.read_policy(location)
-            if not success:
-                # import error
-                return -1, []
-            num_updates = 0
-            # remove duplicates
-            for domain in domains:
-                if domain in self.policy:
-                    num_updates += 1
-                    if merge:
-                        domain_pos = self.policy.index(domain)
-                        del self.policy[domain_pos]
-                        del self.policy_dict[domain]
-            if merge:
-                self.policy.extend(domains)
-                self.policy_dict.update(domains_dict)
-            return num_updates, domains
-        except:
-            # something is wrong with the policy format
-            traceback.print_exc()
-            return -1, []
-
-    def save(self, reload=True):
-        """Saves the policy. If reload=True, the saved policy is loaded into kernel"""
-        time = datetime.datetime.now().strftime("%F.%T")
-        filename = "domain_policy.%s.conf" % time
-        full_filename = "/etc/%s/%s" % (self.version, filename)
-        # are we working on a real file or a symbolic link?
-        try:
-            status = os.lstat(self.location)
-            if S_ISLNK(status.st_mode):
-                # remove old link, new one will be created instead
-                os.unlink(self.location)
-                os.symlink(filename, self.location)
-            else:
-                os.rename(self.location, "%s.old" % self.location)
-            self.write_policy(full_filename, self.policy)
-        except:
-            print >>sys.stderr, "Unable to save TOMOYO policy: %s" % sys.exc_value[1]
-            return False
-        if reload:
-            os.system(self.POLICY_LOAD)
-        return True
-
-    def write_policy(self, filename, entries):
-        """Exports specified entries to a file"""
-        fd = open(filename, "w")
-        for item in entries:
-            print >>fd, "%s\n" % item
-            for acl, val in self.policy_dict[item]:
-                print >>fd, "%s %s" % (acl, val)
-                # compatibility with tomoyo-savepolicy
-                if acl == "use_policy":
-                    print >>fd
-            print >>fd
-
-class TomoyoExceptions:
-    POLICY_LOAD="/usr/sbin/tomoyo-loadpolicy fe"
-    POLICY_SAVE="/usr/sbin/tomoyo-savepolicy fe"
-    def __init__(self, policy="system", version="tomoyo"):
-        """Initializes the exceptions class.
-
-        If version is "tomoyo", LSM version of tomoyo is used.
-        Otherwise, if policy is "ccs", Tomoyo 1.6 policy is used.
-
-        If policy=system, reads policy from /etc/(tomoyo,ccs)/exceptions.
-        If policy=kernel, policy is read from /sys/kernel/security/tomoyo/exceptions"""
-        self.policy = policy
-        self.version = version
-        if policy == "kernel":
-            self.exceptions_location = "/sys/kernel/security/tomoyo/exception_policy"
-        else:
-            self.exceptions_location = "/etc/%s/exception_policy.conf" % version
-        self.save_location = "exceptions_policy.conf"
-
-    def reload(self):
-        """Reloads the policy. If using system policy, current kernel policy is saved first"""
-        if self.policy == "system":
-            os.system(self.POLICY_SAVE)
-        success, self.exceptions = self.read_policy(self.exceptions_location)
-        return success
-
-    def read_policy(self, location):
-        """Reads a policy from file"""
-        success = True
-        try:
-            with open(location) as fd:
-                data = fd.readlines()
-        except:
-            # unable to open policy file
-            print >>sys.stderr, "Unable to open exceptions file: %s" % self.exceptions_location
-            data = []
-            success = False
-
-        # parse exceptions
-        exceptions = {}
-        # initialize known exception tykes
-        for exc in ["file_pattern", "allow_read", "deny_rewrite", "alias", "initialize_domain", "no_initialize_domain", "keep_domain", "no_keep_domain"]:
-            exceptions[exc] = []
-        for line in data:
-            acl, params = line.strip().split(" ", 1)
-            if acl not in exceptions:
-                exceptions[acl] = []
-            exceptions[acl].append(params)
-        return success, exceptions
-
-    def save(self, reload=True):
-        """Saves the policy. If reload=True, the saved policy is loaded into kernel"""
-        time = datetime.datetime.now().strftime("%F.%T")
-        filename = "exceptions_policy.%s.conf" % time
-        full_filename = "/etc/%s/%s" % (self.version, filename)
-        # are we working on a real file or a symbolic link?
-        try:
-            status = os.lstat(self.exceptions_location)
-            if S_ISLNK(status.st_mode):
-                # remove old link, new one will be created instead
-                os.unlink(self.exceptions_location)
-                os.symlink(filename, self.exceptions_location)
-            else:
-                os.rename(self.location, "%s.bak.%s" % (self.exceptions_location, time))
-            self.write_exceptions(full_filename, self.exceptions)
-        except:
-            traceback.print_exc()
-            print >>sys.stderr, "Unable to save TOMOYO exceptions: %s" % sys.exc_value[1]
-            return False
-        if reload:
-            os.system(self.POLICY_LOAD)
-        return True
-
-    def write_exceptions(self, filename, entries):
-        """Exports specified entries to a file"""
-        fd = open(filename, "w")
-        for item in entries:
-            for val in entries[item]:
-                print >>fd, "%s %s" % (item, val)
 
 # {{{ usage
 def usage():
@@ -1293,16 +1698,39 @@ Arguments to msecgui:
     -h, --help              displays this helpful message.
     -d, --debug             enable debugging output
     -e, --embedded <XID>    embed in MCC.
-"""
+    -f, --full-reload       reload the whole policy into kernel when applying changes
+    -s, --securityfs <dir>  location of TOMOYO kernel interface
+                            (default: %s)
+    -c, --cache <dir>       location of parsed policy cache
+                            (default: %s)
+    -n, --no-cache          do not cache parsed policy
+    -H, --history <dir>     location of saved policies
+                            (default: %s)
+    --no-history            do not record saved policies
+    -j, --jobs <number>     number of processes parsing large policies
+                            (default: number of CPUs)
+    -t, --profile <file>    record time and memory spent in each phase, and
+                            save them into file when leaving
+    -T, --profile-calls <file>
+                            also profile function calls with cProfile, saving
+                            them into file
+""" % (TomoyoPolicy.SECURITYFS, PolicyCache.CACHE_DIR, PolicyHistory.HISTORY_DIR)
 # }}}
 
 
 if __name__ == "__main__":
     PlugWindowID = None
+    securityfs = TomoyoPolicy.SECURITYFS
+    delta = True
+    cache_dir = PolicyCache.CACHE_DIR
+    history_dir = PolicyHistory.HISTORY_DIR
+    jobs = None
+    profile_file = None
+    calls_file = None
 
     # parse command line
     try:
-        opt, args = getopt.getopt(sys.argv[1:], 'hde:', ['help', 'debug', 'embedded='])
+        opt, args = getopt.getopt(sys.argv[1:], 'hde:fs:c:nH:j:t:T:', ['help', 'debug', 'embedded=', 'full-reload', 'securityfs=', 'cache=', 'no-cache', 'history=', 'no-history', 'jobs=', 'profile=', 'profile-calls='])
     except getopt.error:
         usage()
         sys.exit(1)
@@ -1314,15 +1742,47 @@ if __name__ == "__main__":
         # list
         elif o[0] == '-d' or o[0] == '--debug':
             DEBUG=True
+            tomoyo_policy.DEBUG=True
         elif o[0] == '-e' or o[0] == '--embedded':
             try:
                 PlugWindowID = long(o[1])
             except:
                 print >>sys.stderr, "Error: bad master window XID (%s)!" % o[1]
                 sys.exit(1)
-
-    policy = TomoyoPolicy()
-    exceptions = TomoyoExceptions()
+        elif o[0] == '-f' or o[0] == '--full-reload':
+            delta = False
+        elif o[0] == '-s' or o[0] == '--securityfs':
+            securityfs = o[1]
+        elif o[0] == '-c' or o[0] == '--cache':
+            cache_dir = o[1]
+        elif o[0] == '-n' or o[0] == '--no-cache':
+            cache_dir = None
+        elif o[0] == '-H' or o[0] == '--history':
+            history_dir = o[1]
+        elif o[0] == '--no-history':
+            history_dir = None
+        elif o[0] == '-j' or o[0] == '--jobs':
+            try:
+                jobs = int(o[1])
+            except:
+                print >>sys.stderr, "Error: bad number of jobs (%s)!" % o[1]
+                sys.exit(1)
+        elif o[0] == '-t' or o[0] == '--profile':
+            profile_file = o[1]
+        elif o[0] == '-T' or o[0] == '--profile-calls':
+            calls_file = o[1]
+
+    if profile_file or calls_file:
+        tomoyo_policy.PROFILER = Profiler(calls=calls_file is not None)
+
+    cache = None
+    if cache_dir:
+        cache = PolicyCache(cache_dir)
+    history = None
+    if history_dir:
+        history = PolicyHistory(history_dir)
+    policy = TomoyoPolicy(securityfs=securityfs, delta=delta, cache=cache, jobs=jobs, history=history)
+    exceptions = TomoyoExceptions(securityfs=securityfs, delta=delta, cache=cache, history=history)
 
     gtk.gdk.threads_init()
 
@@ -1330,3 +1790,6 @@ if __name__ == "__main__":
     TomoyoGui(policy, exceptions, embed=PlugWindowID)
     gtk.gdk.threads_leave()
     gtk.main()
+
+    if tomoyo_policy.PROFILER:
+        tomoyo_policy.PROFILER.dump(profile_file, calls_file)
@@ -0,0 +1,330 @@
+#!/usr/bin/python
+"""Command line interface to TOMOYO policy"""
+
+import getopt
+import os
+import shutil
+import sys
+import tempfile
+
+import tomoyo_policy
+from tomoyo_policy import TomoyoPolicy, TomoyoExceptions, PolicyCache, PolicyHistory, DomainSearchIndex, PolicyDiff, Profiler, open_policy, profile, run_command, run_parallel
+
+# {{{ usage
+def usage():
+    """Prints help message"""
+    print """Tomoyo policy tool.
+
+Usage: tomoyo-policy [options] <command> [arguments]
+
+Commands:
+    load                        load system policy into kernel
+    save                        save kernel policy into system policy
+    query [<text>]              list domains containing text, with their profile
+    set-profile <profile> <domain>...
+                                change profile of domains
+    export <file> [<text>]      export domains containing text into file
+                                (all domains by default, - for standard output)
+    import <file>               merge domains from file into policy
+    unmerge <file>              remove ACL entries of domains in file from policy
+    compact [<text>]            remove redundant ACL entries of domains containing text
+                                (all domains by default)
+    diff <old> <new>            show differences between two policies, each one being
+                                a policy file, "system", "kernel" or a saved policy
+    history                     list saved policies
+    restore <save>              restore a saved policy or exceptions into system files
+
+Options:
+    -h, --help              displays this helpful message.
+    -d, --debug             enable debugging output
+    -p, --policy <file>     work on a policy file instead of system policy
+    -e, --exceptions <file> read exceptions from a file instead of system exceptions
+    -a, --acl               list ACL entries of queried domains
+    -r, --recursive         also change profile of subdomains
+    -N, --no-reload         do not load changed policy into kernel
+    -D, --dry-run           only show what would be compacted
+    -f, --full-reload       reload the whole policy into kernel when applying changes
+    -s, --securityfs <dir>  location of TOMOYO kernel interface
+                            (default: %s)
+    -c, --cache <dir>       location of parsed policy cache
+                            (default: %s)
+    -n, --no-cache          do not cache parsed policy
+    -H, --history <dir>     location of saved policies
+                            (default: %s)
+    --no-history            do not record saved policies
+    --no-compress           do not compress recorded policies
+    -j, --jobs <number>     number of processes parsing large policies
+                            (default: number of CPUs)
+    -t, --profile <file>    save time and memory spent in each phase into file
+    -T, --profile-calls <file>
+                            save function calls profiled with cProfile into file
+""" % (TomoyoPolicy.SECURITYFS, PolicyCache.CACHE_DIR, PolicyHistory.HISTORY_DIR)
+# }}}
+
+def error(message):
+    """Reports an error and exits"""
+    print >>sys.stderr, "tomoyo-policy: %s" % message
+    sys.exit(1)
+
+def load_policy(policy, save_kernel=True):
+    """Loads the policy.
+
+    If save_kernel is False, system policy file is read as is, without saving
+    kernel policy into it first."""
+    if save_kernel:
+        result = policy.load()
+    else:
+        with profile("parse domains"):
+            result = policy.read_policy(policy.location)
+    if not policy.update(result):
+        error("unable to load policy: %s" % (policy.error or policy.location))
+
+def save_policy(policy, location, reload):
+    """Saves changed policy into a file, or the system policy if location is None"""
+    if not policy.is_modified():
+        return
+    if location:
+        try:
+            with profile("save domains"):
+                policy.write_policy(location, policy.policy)
+        except:
+            error("unable to save policy: %s" % sys.exc_value)
+    elif not policy.save(reload):
+        error("unable to save policy: %s" % policy.error)
+
+def load_exceptions(exceptions):
+    """Loads the exceptions"""
+    if not exceptions.update(exceptions.load()):
+        error("unable to load exceptions: %s" % (exceptions.error or exceptions.exceptions_location))
+
+def find_domains(policy, text):
+    """Returns domains containing text, in policy order"""
+    if not text:
+        return list(policy.policy)
+    return DomainSearchIndex(policy.policy).search(text)
+
+def run_tools(commands):
+    """Runs TOMOYO policy tools"""
+    for command in commands:
+        status, err = run_command(command)
+        if status != 0:
+            error(err)
+
+if __name__ == "__main__":
+    location = None
+    exceptions_location = None
+    securityfs = TomoyoPolicy.SECURITYFS
+    delta = True
+    reload = True
+    dry_run = False
+    recursive = False
+    show_acl = False
+    cache_dir = PolicyCache.CACHE_DIR
+    history_dir = PolicyHistory.HISTORY_DIR
+    compress = True
+    jobs = None
+    profile_file = None
+    calls_file = None
+
+    # parse command line
+    try:
+        opt, args = getopt.getopt(sys.argv[1:], 'hdp:e:arNDfs:c:nH:j:t:T:', ['help', 'debug', 'policy=', 'exceptions=', 'acl', 'recursive', 'no-reload', 'dry-run', 'full-reload', 'securityfs=', 'cache=', 'no-cache', 'history=', 'no-history', 'no-compress', 'jobs=', 'profile=', 'profile-calls='])
+    except getopt.error:
+        usage()
+        sys.exit(1)
+    for o in opt:
+        # help
+        if o[0] == '-h' or o[0] == '--help':
+            usage()
+            sys.exit(0)
+        elif o[0] == '-d' or o[0] == '--debug':
+            tomoyo_policy.DEBUG=True
+        elif o[0] == '-p' or o[0] == '--policy':
+            location = o[1]
+        elif o[0] == '-e' or o[0] == '--exceptions':
+            exceptions_location = o[1]
+        elif o[0] == '-a' or o[0] == '--acl':
+            show_acl = True
+        elif o[0] == '-r' or o[0] == '--recursive':
+            recursive = True
+        elif o[0] == '-N' or o[0] == '--no-reload':
+            reload = False
+        elif o[0] == '-D' or o[0] == '--dry-run':
+            dry_run = True
+        elif o[0] == '-f' or o[0] == '--full-reload':
+            delta = False
+        elif o[0] == '-s' or o[0] == '--securityfs':
+            securityfs = o[1]
+        elif o[0] == '-c' or o[0] == '--cache':
+            cache_dir = o[1]
+        elif o[0] == '-n' or o[0] == '--no-cache':
+            cache_dir = None
+        elif o[0] == '-H' or o[0] == '--history':
+            history_dir = o[1]
+        elif o[0] == '--no-history':
+            history_dir = None
+        elif o[0] == '--no-compress':
+            compress = False
+        elif o[0] == '-j' or o[0] == '--jobs':
+            try:
+                jobs = int(o[1])
+            except:
+                error("bad number of jobs (%s)" % o[1])
+        elif o[0] == '-t' or o[0] == '--profile':
+            profile_file = o[1]
+        elif o[0] == '-T' or o[0] == '--profile-calls':
+            calls_file = o[1]
+    if not args:
+        usage()
+        sys.exit(1)
+
+    if profile_file or calls_file:
+        tomoyo_policy.PROFILER = Profiler(calls=calls_file is not None)
+
+    cache = None
+    if cache_dir:
+        cache = PolicyCache(cache_dir)
+    history = None
+    if history_dir:
+        history = PolicyHistory(history_dir, compress)
+    if location:
+        # policy file is used as is, without saving kernel policy first
+        policy = TomoyoPolicy(policy="file", securityfs=securityfs, delta=delta, cache=cache, jobs=jobs)
+        policy.location = location
+    else:
+        policy = TomoyoPolicy(securityfs=securityfs, delta=delta, cache=cache, jobs=jobs, history=history)
+    if location or exceptions_location:
+        exceptions = TomoyoExceptions(policy="file", securityfs=securityfs, delta=delta, cache=cache)
+        if exceptions_location:
+            exceptions.exceptions_location = exceptions_location
+    else:
+        exceptions = TomoyoExceptions(securityfs=securityfs, delta=delta, cache=cache, history=history)
+    command, args = args[0], args[1:]
+
+    if command == "load" and not args:
+        run_tools([TomoyoPolicy.POLICY_LOAD, TomoyoExceptions.POLICY_LOAD])
+    elif command == "save" and not args:
+        run_tools([TomoyoPolicy.POLICY_SAVE, TomoyoExceptions.POLICY_SAVE])
+    elif command == "query" and len(args) <= 1:
+        # kernel policy is only saved by save command
+        load_policy(policy, save_kernel=False)
+        for domain in find_domains(policy, "".join(args)):
+            print "%d\t%s" % (policy.policy_profile.get(domain, 0), domain)
+            if show_acl:
+                for acl in policy.policy_dict[domain]:
+                    print "\t%s %s" % acl
+    elif command == "set-profile" and len(args) >= 2:
+        try:
+            new_profile = int(args[0])
+        except ValueError:
+            error("bad profile (%s)" % args[0])
+        load_policy(policy)
+        domains = []
+        for domain in args[1:]:
+            if domain not in policy.policy:
+                error("unknown domain: %s" % domain)
+            if recursive:
+                domains.extend(policy.subdomains(domain))
+            else:
+                domains.append(domain)
+        policy.set_profile(domains, new_profile)
+        save_policy(policy, location, reload)
+    elif command == "export" and 1 <= len(args) <= 2:
+        load_policy(policy, save_kernel=False)
+        domains = find_domains(policy, "".join(args[1:]))
+        if args[0] == "-":
+            sys.stdout.writelines(policy.format_policy(domains))
+        else:
+            try:
+                policy.write_policy(args[0], domains)
+            except:
+                error("unable to export policy: %s" % sys.exc_value)
+    elif command == "import" and len(args) == 1:
+        load_policy(policy)
+        num_updates, domains = policy.import_policy(args[0], merge=True)
+        if num_updates < 0:
+            error("unable to import policy from %s" % args[0])
+        print "Imported %d domains, %d merged into existing ones" % (len(domains), num_updates)
+        save_policy(policy, location, reload)
+    elif command == "unmerge" and len(args) == 1:
+        load_policy(policy)
+        num_updates, domains = policy.import_policy(args[0], unmerge=True)
+        if num_updates < 0:
+            error("unable to import policy from %s" % args[0])
+        print "Unmerged %d domains, %d changed" % (num_updates, len(policy.dirty))
+        save_policy(policy, location, reload)
+    elif command == "compact" and len(args) <= 1:
+        load_policy(policy)
+        load_exceptions(exceptions)
+        with profile("compact domains"):
+            compacted = policy.compact(exceptions, find_domains(policy, "".join(args)))
+        total_removed = total_saved = 0
+        for domain, acl, duplicates, collapsed, granted, saved in compacted:
+            print "%s\n\t%d duplicated, %d covered by file_pattern, %d granted by allow_read, %d bytes saved" % (domain,
+                    duplicates, collapsed, granted, saved)
+            total_removed += duplicates + collapsed + granted
+            total_saved += saved
+        print "Compacted %d domains, %d entries removed, %d bytes saved" % (len(compacted), total_removed, total_saved)
+        if not dry_run:
+            policy.apply_compaction(compacted)
+            save_policy(policy, location, reload)
+    elif command == "diff" and len(args) == 2:
+        saved = [history is not None and history.exists(source) for source in args]
+        tmpdir = tempfile.mkdtemp(prefix="tomoyo-policy.")
+        try:
+            if saved[0] and saved[1]:
+                # saved policies or exceptions
+                try:
+                    with profile("compare domains"):
+                        diff = history.diff(args[0], args[1], jobs=jobs)
+                except:
+                    error("unable to compare saved policies: %s" % sys.exc_value)
+            else:
+                sources = list(args)
+                for pos, source in enumerate(args):
+                    if saved[pos]:
+                        if history.manifest(source)["kind"] != "domain":
+                            error("not a saved domain policy: %s" % source)
+                        sources[pos] = os.path.join(tmpdir, source)
+                        history.restore(source, sources[pos])
+                old, new = [open_policy(source, securityfs=securityfs, cache=cache, jobs=jobs) for source in sources]
+                old_result, new_result = run_parallel(old.load, new.load)
+                for source, policy, result in [(args[0], old, old_result), (args[1], new, new_result)]:
+                    if not policy.update(result):
+                        error("unable to load policy: %s" % source)
+                with profile("compare domains"):
+                    diff = PolicyDiff(old, new)
+        finally:
+            # restored policy files are memory-mapped, and may be removed now
+            shutil.rmtree(tmpdir)
+        sys.stdout.writelines(diff.format())
+        print >>sys.stderr, "%d domains added, %d removed, %d changed, %d ACL entries added, %d removed" % (diff.added,
+                diff.removed, diff.changed, diff.added_acl, diff.removed_acl)
+    elif command == "history" and not args:
+        if not history:
+            error("history of saved policies is disabled")
+        for id, manifest in history.saves():
+            print "%s\t%s\t%d blocks, %d bytes, %d bytes stored" % (id, manifest["location"],
+                    manifest["blocks"], manifest["size"], manifest["stored"])
+    elif command == "restore" and len(args) == 1:
+        if not history or not history.exists(args[0]):
+            error("unknown saved policy: %s" % args[0])
+        if history.manifest(args[0])["kind"] == "domain":
+            target, tool = policy.location, TomoyoPolicy.POLICY_LOAD
+        else:
+            target, tool = exceptions.exceptions_location, TomoyoExceptions.POLICY_LOAD
+        try:
+            # replaced file can be restored as well
+            history.record_file(history.manifest(args[0])["kind"], os.path.realpath(target), target)
+            history.restore(args[0], os.path.realpath(target))
+        except:
+            error("unable to restore %s: %s" % (args[0], sys.exc_value))
+        print "Restored %s into %s" % (args[0], target)
+        if reload and not location and not exceptions_location:
+            run_tools([tool])
+    else:
+        usage()
+        sys.exit(1)
+
+    if tomoyo_policy.PROFILER:
+        tomoyo_policy.PROFILER.dump(profile_file, calls_file)
@@ -0,0 +1,2091 @@
+"""TOMOYO policy and exceptions handling, without GUI dependencies"""
+
+import cProfile
+import gc
+import hashlib
+import json
+import marshal
+import mmap
+import multiprocessing
+import os
+import pstats
+import re
+import resource
+from stat import *
+import datetime
+import sys
+import shlex
+import shutil
+import subprocess
+import tempfile
+import traceback
+import zlib
+
+from threading import Thread, Lock, local
+import time
+
+from array import array
+from itertools import izip, tee
+from collections import OrderedDict
+from bisect import bisect_right
+
+DEBUG=False
+# phase profiler, see profile()
+PROFILER=None
+
+try:
+    import tracemalloc
+except ImportError:
+    # not available before python 3.4
+    tracemalloc = None
+
+def write_file(filename, blocks, block_size=1<<20, backup=None):
+    """Atomically writes blocks of text into a file.
+
+    Blocks are gathered into large writes to a temporary file, which is synced to
+    disk and then renamed over filename, so filename is never left half-written.
+    If backup is given, the replaced file is kept under that name."""
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmpname = tempfile.mkstemp(prefix=".%s." % os.path.basename(filename), dir=dirname)
+    linkname = None
+    try:
+        # keep permissions of existing file
+        try:
+            mode = S_IMODE(os.stat(filename).st_mode)
+        except OSError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0666 & ~umask
+        os.fchmod(fd, mode)
+        buffer = []
+        size = 0
+        for block in blocks:
+            buffer.append(block)
+            size += len(block)
+            if size >= block_size:
+                os.write(fd, "".join(buffer))
+                buffer = []
+                size = 0
+        os.write(fd, "".join(buffer))
+        os.fsync(fd)
+        os.close(fd)
+        fd = None
+        if backup is not None and os.path.exists(filename):
+            # old file is linked under a temporary name first, so an older backup
+            # is only replaced once the old file is kept
+            linkname = "%s.link" % tmpname
+            os.link(filename, linkname)
+            os.rename(linkname, backup)
+            linkname = None
+        os.rename(tmpname, filename)
+    except:
+        if fd is not None:
+            os.close(fd)
+        os.unlink(tmpname)
+        if linkname is not None and os.path.exists(linkname):
+            os.unlink(linkname)
+        raise
+    sync_dir(dirname)
+
+def sync_dir(dirname):
+    """Syncs directory entries to disk"""
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def run_command(command):
+    """Runs a command, returning its exit status and error output"""
+    try:
+        proc = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, close_fds=True)
+    except OSError:
+        return -1, "%s: %s" % (command, sys.exc_value.strerror)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        err = "%s: %s" % (command, err.strip() or "exited with status %d" % proc.returncode)
+    return proc.returncode, err.strip()
+
+def run_parallel(*jobs):
+    """Runs functions in parallel threads, returning the list of their results.
+
+    If a function raises an exception, it is raised again once all threads have finished."""
+    results = [None] * len(jobs)
+    errors = []
+    def run(pos, job):
+        try:
+            results[pos] = job()
+        except:
+            errors.append(sys.exc_info())
+    threads = [Thread(target=run, args=(pos, job)) for pos, job in enumerate(jobs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        type, value, tb = errors[0]
+        raise type, value, tb
+    return results
+
+def write_kernel_policy(filename, lines):
+    """Writes policy statements into a TOMOYO securityfs interface"""
+    data = "".join(lines)
+    fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        offset = 0
+        while offset < len(data):
+            offset += os.write(fd, buffer(data, offset))
+    finally:
+        os.close(fd)
+
+def scan_policy_chunk(data, start, end, progress=None):
+    """Scans part of a policy file for domain headers and profiles.
+
+    The part must start at a domain header, unless it starts at the beginning of the
+    file. Returns (domains, spans, profile), where domains lists the domains found in
+    the order of the file, spans holds the ranges of ACL entries of each domain and
+    profile the use_profile settings found. Raises ValueError on syntax errors."""
+    domains = []
+    spans = {}
+    profile = {}
+    next_report = start
+    domain = None
+    for match in TomoyoPolicy.POLICY_SCAN.finditer(data, start, end):
+        offset = match.start()
+        if progress and offset >= next_report:
+            progress(offset, end)
+            next_report = offset + TomoyoPolicy.PROGRESS_STEP
+        header, use_profile, error = match.groups()
+        if domain is None:
+            if header is None or TomoyoPolicy.NONBLANK.search(data, start, offset):
+                raise ValueError("ACL outside of a domain: %s" % data[start:match.end()].strip().split("\n")[0])
+        elif TomoyoPolicy.NONBLANK.search(data, start, offset):
+            spans[domain].append((start, offset))
+        if error is not None:
+            raise ValueError("Invalid ACL entry: %s" % error)
+        if header is not None:
+            domain = header.strip()
+            if domain not in spans:
+                domains.append(domain)
+                spans[domain] = []
+        else:
+            profile[domain] = int(use_profile)
+        start = match.end()
+    if domain is None:
+        if TomoyoPolicy.NONBLANK.search(data, start, end):
+            raise ValueError("ACL outside of a domain")
+    elif TomoyoPolicy.NONBLANK.search(data, start, end):
+        spans[domain].append((start, end))
+    return domains, spans, profile
+
+def scan_policy_file(args):
+    """Scans part of a policy file in a worker process"""
+    location, start, end = args
+    with open(location, "rb") as fd:
+        data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    return scan_policy_chunk(data, start, end)
+
+class Profiler:
+    """Records time and memory spent in each phase of policy handling.
+
+    For each phase, the number of runs, total and longest time, change in number of
+    objects tracked by the garbage collector and peak process size are recorded.
+    When tracemalloc is available, peak memory allocated during the phase is
+    recorded as well. If calls=True, functions called during phases are profiled
+    with cProfile."""
+    def __init__(self, calls=False):
+        """Initializes the profiler"""
+        self.phases = {}
+        self.order = []
+        self.lock = Lock()
+        self.calls = calls
+        self.profiles = []
+        # phases running in current thread
+        self.running = local()
+        if tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def phase(self, name):
+        """Returns a context measuring a phase"""
+        return ProfilerPhase(self, name)
+
+    def record(self, name, elapsed, objects, allocated):
+        """Records a run of a phase"""
+        with self.lock:
+            if name not in self.phases:
+                self.order.append(name)
+                self.phases[name] = {"runs": 0, "time": 0.0, "max_time": 0.0, "objects": 0, "maxrss": 0}
+            phase = self.phases[name]
+            phase["runs"] += 1
+            phase["time"] += elapsed
+            phase["max_time"] = max(phase["max_time"], elapsed)
+            phase["objects"] += objects
+            phase["maxrss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if allocated is not None:
+                phase["allocated"] = max(phase.get("allocated", 0), allocated)
+
+    def report(self):
+        """Returns list of (name, phase) tuples, in the order phases were first run"""
+        with self.lock:
+            return [(name, dict(self.phases[name])) for name in self.order]
+
+    def dump(self, filename=None, calls_filename=None):
+        """Writes recorded phases into a JSON file, and profiled calls into a pstats file"""
+        if filename:
+            with open(filename, "w") as fd:
+                json.dump({"phases": [dict(phase, name=name) for name, phase in self.report()], "maxrss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}, fd, indent=1)
+        if calls_filename and self.profiles:
+            stats = pstats.Stats(self.profiles[0])
+            for profile in self.profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(calls_filename)
+
+class ProfilerPhase:
+    """A running phase of the profiler"""
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.profile = None
+
+    def __enter__(self):
+        self.objects = len(gc.get_objects())
+        if tracemalloc:
+            self.traced = tracemalloc.get_traced_memory()[0]
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+        # profiling calls in nested phases would stop profiling their parent
+        if self.profiler.calls and not getattr(self.profiler.running, "profile", None):
+            self.profile = cProfile.Profile()
+            self.profiler.running.profile = self.profile
+            self.profile.enable()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, tb):
+        elapsed = time.time() - self.start
+        if self.profile:
+            self.profile.disable()
+            self.profiler.running.profile = None
+            with self.profiler.lock:
+                self.profiler.profiles.append(self.profile)
+        allocated = None
+        if tracemalloc:
+            allocated = max(tracemalloc.get_traced_memory()[1] - self.traced, 0)
+        self.profiler.record(self.name, elapsed, len(gc.get_objects()) - self.objects, allocated)
+        return False
+
+class NoProfile:
+    """Context doing nothing when profiling is disabled"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        return False
+
+def profile(name):
+    """Returns a context measuring a phase when profiling is enabled.
+
+    Usage: with profile("parse"): ..."""
+    if PROFILER:
+        return PROFILER.phase(name)
+    return NoProfile()
+
+class PolicyCache:
+    """On-disk cache of parsed policies.
+
+    Parsed data is stored with marshal in snapshots named after the content hash of
+    the file it was parsed from. An index maps the path, size and modification time
+    of files to their hash, so unchanged files are found without reading them."""
+    CACHE_DIR="/var/cache/tomoyo-gui"
+    # maximum size of all snapshots
+    MAX_SIZE=256<<20
+    # bumped whenever the format of parsed data changes, or files are parsed differently
+    VERSION=2
+
+    def __init__(self, directory=CACHE_DIR, max_size=MAX_SIZE):
+        """Initializes the cache in a directory"""
+        self.directory = directory
+        self.max_size = max_size
+        self.index_file = os.path.join(directory, "index")
+        self.digests = {}
+
+    def file_key(self, location):
+        """Returns the key identifying current version of a file, or None if it is not cacheable"""
+        try:
+            location = os.path.realpath(location)
+            status = os.stat(location)
+        except OSError:
+            return None
+        if not S_ISREG(status.st_mode):
+            # kernel interfaces are never cached
+            return None
+        return "%s:%d:%s" % (location, status.st_size, repr(status.st_mtime))
+
+    def digest(self, location, key):
+        """Returns content hash of a file"""
+        if key in self.digests:
+            return self.digests[key]
+        index = self.read_index()
+        if key in index:
+            return index[key]
+        md5 = hashlib.md5()
+        with open(location, "rb") as fd:
+            while True:
+                data = fd.read(1<<20)
+                if not data:
+                    break
+                md5.update(data)
+        self.digests[key] = md5.hexdigest()
+        return self.digests[key]
+
+    def snapshot(self, kind, digest):
+        """Returns name of a snapshot file"""
+        return os.path.join(self.directory, "%s-%s.v%d" % (kind, digest, self.VERSION))
+
+    def read_index(self):
+        """Reads the index of known files"""
+        try:
+            with open(self.index_file, "rb") as fd:
+                return marshal.load(fd)
+        except:
+            return {}
+
+    def update_index(self, key, digest):
+        """Remembers content hash of a file"""
+        index = self.read_index()
+        if index.get(key) == digest:
+            return
+        index[key] = digest
+        # forget files whose snapshots were evicted
+        snapshots = set([name.split("-", 1)[1].split(".")[0] for name in os.listdir(self.directory) if "-" in name])
+        for item in index.keys():
+            if index[item] not in snapshots:
+                del index[item]
+        write_file(self.index_file, [marshal.dumps(index)])
+
+    def load(self, kind, location):
+        """Returns data parsed from a file, or None if it is not cached"""
+        key = self.file_key(location)
+        if not key:
+            return None
+        try:
+            digest = self.digest(location, key)
+            snapshot = self.snapshot(kind, digest)
+            with open(snapshot, "rb") as fd:
+                data = marshal.load(fd)
+            # keep recently used snapshots
+            os.utime(snapshot, None)
+            self.update_index(key, digest)
+        except:
+            return None
+        if DEBUG:
+            print "Loaded %s from cache %s" % (location, snapshot)
+        return data
+
+    def store(self, kind, location, data):
+        """Stores data parsed from a file"""
+        key = self.file_key(location)
+        if not key:
+            return
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory, 0700)
+            digest = self.digest(location, key)
+            write_file(self.snapshot(kind, digest), [marshal.dumps(data)])
+            self.evict()
+            self.update_index(key, digest)
+        except:
+            print >>sys.stderr, "Unable to cache %s: %s" % (location, sys.exc_value)
+
+    def evict(self):
+        """Removes least recently used snapshots until cache fits its maximum size"""
+        snapshots = []
+        size = 0
+        for name in os.listdir(self.directory):
+            if name == "index" or name.startswith("."):
+                continue
+            filename = os.path.join(self.directory, name)
+            status = os.stat(filename)
+            snapshots.append((status.st_mtime, status.st_size, filename))
+            size += status.st_size
+        snapshots.sort()
+        for mtime, filesize, filename in snapshots:
+            if size <= self.max_size:
+                break
+            os.unlink(filename)
+            size -= filesize
+
+class MappedPolicy:
+    """ACL of security domains, parsed on demand from a memory-mapped policy file.
+
+    The ACL of each domain is kept as a list of byte ranges of the mapping until it
+    is accessed, when it is parsed into a list of (command, params) tuples. Supports
+    the dictionary operations used on parsed policies."""
+    def __init__(self, data, spans):
+        """Initializes the ACL from mapped data and a dictionary of ranges of each domain"""
+        self.data = data
+        self.spans = spans
+        self.acls = {}
+
+    def parse(self, domain):
+        """Parses ACL of a domain"""
+        acl = []
+        for start, end in self.spans.pop(domain):
+            for line in self.data[start:end].split("\n"):
+                line = line.strip()
+                if line:
+                    command, params = line.split(" ", 1)
+                    acl.append((command, params))
+        self.acls[domain] = acl
+        return acl
+
+    def raw_acl(self, domain):
+        """Returns ACL text of a domain as found in the policy file, or None if it was parsed"""
+        if domain not in self.spans:
+            return None
+        acl = []
+        for start, end in self.spans[domain]:
+            acl.append("%s\n" % self.data[start:end].strip())
+        return "".join(acl)
+
+    def __getitem__(self, domain):
+        if domain in self.acls:
+            return self.acls[domain]
+        if domain in self.spans:
+            return self.parse(domain)
+        raise KeyError(domain)
+
+    def __setitem__(self, domain, acl):
+        self.spans.pop(domain, None)
+        self.acls[domain] = acl
+
+    def __delitem__(self, domain):
+        if domain in self.spans:
+            del self.spans[domain]
+        else:
+            del self.acls[domain]
+
+    def __contains__(self, domain):
+        return domain in self.acls or domain in self.spans
+
+    def __len__(self):
+        return len(self.acls) + len(self.spans)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return self.acls.keys() + self.spans.keys()
+
+    def get(self, domain, default=None):
+        if domain in self:
+            return self[domain]
+        return default
+
+    def update(self, acls):
+        for domain in acls.keys():
+            self[domain] = acls[domain]
+
+class DomainIndex:
+    """Ordered set of security domains.
+
+    Membership tests, position lookups and removals are O(1). Removed domains leave
+    holes in the list, which are compacted on the next positional access."""
+    def __init__(self, domains=[]):
+        """Initializes the index with a list of domains"""
+        self.domains = []
+        self.positions = {}
+        self.holes = 0
+        self.extend(domains)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, domain):
+        return domain in self.positions
+
+    def __iter__(self):
+        for domain in self.domains:
+            if domain is not None:
+                yield domain
+
+    def __getitem__(self, pos):
+        self.compact()
+        return self.domains[pos]
+
+    def __delitem__(self, pos):
+        self.remove(self[pos])
+
+    def index(self, domain):
+        """Returns position of a domain"""
+        self.compact()
+        try:
+            return self.positions[domain]
+        except KeyError:
+            raise ValueError("%s is not in policy" % domain)
+
+    def append(self, domain):
+        """Appends a domain to the index. Returns False if domain was already known"""
+        if domain in self.positions:
+            return False
+        self.positions[domain] = len(self.domains)
+        self.domains.append(domain)
+        return True
+
+    def extend(self, domains):
+        """Appends a list of domains to the index"""
+        for domain in domains:
+            self.append(domain)
+
+    def remove(self, domain):
+        """Removes a domain from the index"""
+        try:
+            pos = self.positions.pop(domain)
+        except KeyError:
+            raise ValueError("%s is not in policy" % domain)
+        self.domains[pos] = None
+        self.holes += 1
+
+    def sort(self):
+        """Sorts domains by name.
+
+        As space sorts before any other character allowed in domain names, each
+        domain is followed by all its subdomains."""
+        self.compact()
+        self.domains.sort()
+        for pos, domain in enumerate(self.domains):
+            self.positions[domain] = pos
+
+    def compact(self):
+        """Removes holes left by removed domains"""
+        if not self.holes:
+            return
+        self.domains = [domain for domain in self.domains if domain is not None]
+        for pos, domain in enumerate(self.domains):
+            self.positions[domain] = pos
+        self.holes = 0
+
+class DomainSearchIndex:
+    """Substring index over security domain names.
+
+    Domain names are program paths separated by spaces, and transition chains share
+    most of them, so there are far fewer distinct paths than domains. The index maps
+    each distinct path to the positions of the domains containing it. A key is only
+    looked for in the text of distinct paths, and the domains of matching paths are
+    merged, so a search does not scan every domain name. Results are returned in the
+    order of indexed domains."""
+    # number of cached search results
+    CACHE_SIZE = 16
+
+    def __init__(self, domains):
+        """Builds the index for a list of domains"""
+        self.domains = list(domains)
+        ids = {}
+        self.postings = []
+        for pos, domain in enumerate(self.domains):
+            for component in set(domain.split(" ")):
+                id = ids.get(component)
+                if id is None:
+                    id = ids[component] = len(self.postings)
+                    self.postings.append(array('l'))
+                self.postings[id].append(pos)
+        self.components = [None] * len(ids)
+        for component, id in ids.iteritems():
+            self.components[id] = component
+        self.offsets = array('l')
+        offset = 0
+        for component in self.components:
+            self.offsets.append(offset)
+            offset += len(component) + 1
+        self.text = "\n".join(self.components) + "\n"
+        self.cache = {}
+        self.last_key = None
+
+    def search(self, key):
+        """Returns list of domains whose name contains key"""
+        if key in self.cache:
+            return self.cache[key]
+        if self.last_key and key.startswith(self.last_key):
+            # narrowing previous search while user is typing
+            result = [domain for domain in self.cache[self.last_key] if key in domain]
+        else:
+            result = self.find(key)
+        if len(self.cache) >= self.CACHE_SIZE:
+            self.cache.clear()
+        self.cache[key] = result
+        self.last_key = key
+        return result
+
+    def find_components(self, part):
+        """Returns ids of distinct paths containing part"""
+        ids = []
+        pos = self.text.find(part)
+        while pos >= 0:
+            id = bisect_right(self.offsets, pos) - 1
+            ids.append(id)
+            if id + 1 >= len(self.offsets):
+                break
+            # continue from next path
+            pos = self.text.find(part, self.offsets[id + 1])
+        return ids
+
+    def find(self, key):
+        """Looks for key in the whole index"""
+        if "\n" in key:
+            return []
+        parts = [part for part in key.split(" ") if part]
+        if not parts:
+            return [domain for domain in self.domains if key in domain]
+        # domains containing the longest part of key are candidates
+        positions = set()
+        for id in self.find_components(max(parts, key=len)):
+            positions.update(self.postings[id])
+        result = [self.domains[pos] for pos in sorted(positions)]
+        if key != parts[0]:
+            # key spans several paths
+            result = [domain for domain in result if key in domain]
+        return result
+
+# a character of a pathname, in TOMOYO encoding
+PATTERN_CHAR=r"(?:\\\\|\\[0-7]{3}|[^/\\])"
+# regular expressions of TOMOYO pathname wildcards
+PATTERN_WILDCARDS={
+    "*": "[^/]*",
+    "@": "[^/.]*",
+    "?": PATTERN_CHAR,
+    "$": "[0-9]+",
+    "+": "[0-9]",
+    "X": "[0-9a-fA-F]+",
+    "x": "[0-9a-fA-F]",
+    "A": "[a-zA-Z]+",
+    "a": "[a-zA-Z]",
+    }
+
+def translate_component(component):
+    """Translates a pathname component of a TOMOYO pattern into a regular expression"""
+    if "\\-" in component:
+        # pathname subtraction: matches first part but none of the following ones
+        parts = component.split("\\-")
+        excluded = ["(?!%s(?:/|$))" % translate_component(part) for part in parts[1:]]
+        return "%s%s" % ("".join(excluded), translate_component(parts[0]))
+    regex = []
+    pos = 0
+    while pos < len(component):
+        char = component[pos]
+        if char != "\\":
+            regex.append(re.escape(char))
+            pos += 1
+            continue
+        escape = component[pos + 1:pos + 2]
+        if escape == "\\":
+            regex.append(r"\\\\")
+            pos += 2
+        elif escape in PATTERN_WILDCARDS:
+            regex.append(PATTERN_WILDCARDS[escape])
+            pos += 2
+        elif re.match("[0-3][0-7][0-7]$", component[pos + 1:pos + 4]):
+            # encoded character
+            regex.append(re.escape(component[pos:pos + 4]))
+            pos += 4
+        else:
+            raise ValueError("Invalid pattern: %s" % component)
+    return "".join(regex)
+
+def translate_pattern(pattern):
+    """Translates a TOMOYO pathname pattern into a regular expression.
+
+    Pathnames are matched in TOMOYO encoding, where special characters are written
+    as \ooo. Raises ValueError for invalid patterns."""
+    regex = []
+    components = pattern.split("/")
+    repeated = False
+    for pos, component in enumerate(components):
+        if pos > 0 and not repeated:
+            regex.append("/")
+        repeated = component.startswith("\\{") and component.endswith("\\}")
+        if repeated:
+            # one or more directories
+            if pos == len(components) - 1:
+                raise ValueError("Invalid pattern: %s" % pattern)
+            regex.append("(?:%s/)+" % translate_component(component[2:-2]))
+        else:
+            regex.append(translate_component(component))
+    return "".join(regex)
+
+# leading part of a pathname without wildcards
+PATTERN_LITERAL=re.compile(r"(?:\\\\|\\[0-3][0-7][0-7]|[^\\])*")
+
+def is_pattern(path):
+    """Returns True if a pathname contains wildcards"""
+    return PATTERN_LITERAL.match(path).end() < len(path)
+
+class PatternMatcher:
+    """Matches pathnames against a set of TOMOYO pathname patterns.
+
+    Patterns without wildcards are kept in a set. Other patterns are grouped by the
+    directory before their first wildcard, and each group is combined into a single
+    regular expression. A pathname is only checked against the groups of its parent
+    directories, which makes the matcher a trie of directories with small
+    expressions as leaves."""
+    def __init__(self, patterns=[]):
+        """Initializes the matcher with a list of patterns"""
+        self.literals = set()
+        self.groups = {}
+        self.count = 0
+        self.regexes = None
+        # expressions of single patterns, compiled when needed
+        self.compiled = {}
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern):
+        """Adds a pattern. Returns False if it is not a valid pathname pattern"""
+        wildcard = PATTERN_LITERAL.match(pattern).end()
+        if wildcard == len(pattern):
+            self.literals.add(pattern)
+            return True
+        prefix = pattern[:pattern.rfind("/", 0, wildcard) + 1]
+        try:
+            regex = translate_pattern(pattern[len(prefix):])
+        except ValueError:
+            return False
+        self.groups.setdefault(prefix, []).append((self.count, pattern, regex))
+        self.count += 1
+        self.regexes = None
+        return True
+
+    def compile(self):
+        """Combines patterns of each group into a regular expression"""
+        self.regexes = {}
+        for prefix, patterns in self.groups.items():
+            self.regexes[prefix] = re.compile("(?:%s)$" % "|".join([regex for pos, pattern, regex in patterns]))
+
+    def matching_groups(self, path):
+        """Yields (prefix, position) of groups having a pattern which matches a pathname"""
+        if self.regexes is None:
+            self.compile()
+        regexes = self.regexes
+        pos = path.find("/")
+        while pos >= 0:
+            pos += 1
+            regex = regexes.get(path[:pos])
+            if regex and regex.match(path, pos):
+                yield path[:pos], pos
+            pos = path.find("/", pos)
+        # patterns not starting with a directory
+        regex = regexes.get("")
+        if regex is not None and regex.match(path):
+            yield "", 0
+
+    def match(self, path):
+        """Returns True if any pattern matches a pathname"""
+        if path in self.literals:
+            return True
+        for group in self.matching_groups(path):
+            return True
+        return False
+
+    def find(self, path):
+        """Returns the first added pattern which matches a pathname, or None"""
+        if path in self.literals:
+            return path
+        found = None
+        for prefix, start in self.matching_groups(path):
+            # only matching groups are checked pattern by pattern
+            for pos, pattern, regex in self.groups[prefix]:
+                if found is not None and pos >= found[0]:
+                    break
+                if regex not in self.compiled:
+                    self.compiled[regex] = re.compile("(?:%s)$" % regex)
+                if self.compiled[regex].match(path, start):
+                    found = pos, pattern
+        if found is None:
+            return None
+        return found[1]
+
+class ExceptionStore:
+    """Ordered set of exceptions of one type.
+
+    Each exception gets an id, which does not change while it is in the store, so
+    exceptions are found, changed and removed by id or by value in O(1). Adding an
+    exception which is already known returns the id of the existing one."""
+    def __init__(self, values=[]):
+        """Initializes the store with a list of exceptions"""
+        self.entries = OrderedDict()
+        self.ids = {}
+        self.next_id = 0
+        for value in values:
+            self.add(value)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, value):
+        return value in self.ids
+
+    def __iter__(self):
+        return self.entries.itervalues()
+
+    def __getitem__(self, id):
+        return self.entries[id]
+
+    def items(self):
+        """Returns list of (id, exception) tuples"""
+        return self.entries.items()
+
+    def find(self, value):
+        """Returns id of an exception, or None if it is not known"""
+        return self.ids.get(value)
+
+    def add(self, value):
+        """Adds an exception, returning its id"""
+        if value in self.ids:
+            return self.ids[value]
+        id = self.next_id
+        self.next_id += 1
+        self.entries[id] = value
+        self.ids[value] = id
+        return id
+
+    def update(self, id, value):
+        """Changes an exception, keeping its position.
+
+        If the new value is already known, the exception is merged with it and the
+        id of the existing one is returned."""
+        old = self.entries[id]
+        if value == old:
+            return id
+        if value in self.ids:
+            self.remove(id)
+            return self.ids[value]
+        del self.ids[old]
+        self.entries[id] = value
+        self.ids[value] = id
+        return id
+
+    def remove(self, id):
+        """Removes an exception"""
+        del self.ids[self.entries.pop(id)]
+
+def policy_fingerprint(profile, lines):
+    """Returns fingerprint of the profile and set of ACL lines of a domain.
+
+    Digests of unique lines are added together, so the fingerprint depends neither
+    on the order of entries nor on duplicates."""
+    digest = 0
+    for line in set(lines):
+        digest += int(hashlib.md5(line).hexdigest(), 16)
+    return "%d:%032x" % (profile, digest & ((1 << 128) - 1))
+
+class TomoyoPolicy:
+    POLICY_LOAD="/usr/sbin/tomoyo-loadpolicy fsd"
+    POLICY_SAVE="/usr/sbin/tomoyo-savepolicy fsd"
+    SECURITYFS="/sys/kernel/security/tomoyo"
+    # how often (in bytes) parsing progress is reported
+    PROGRESS_STEP=1<<16
+    # domain headers, profiles, and lines which are not ACL entries, as they have
+    # no space between command and parameters
+    POLICY_SCAN=re.compile(r"^[ \t\r]*(?:(<kernel>[^\n]*)|use_profile[ \t]+([^\n]*)|([^ \n]*[^ \t\r\n])[ \t\r]*$)", re.M)
+    NONBLANK=re.compile(r"\S")
+    # files scanned in parallel processes
+    PARALLEL_SIZE=16<<20
+    # ACL entries with a single pathname, which learning mode rewrites with file_pattern
+    SINGLE_PATH_ACL=set(["allow_read/write", "allow_execute", "allow_read", "allow_write", "allow_create",
+        "allow_unlink", "allow_mkdir", "allow_rmdir", "allow_mkfifo", "allow_mksock", "allow_mkblock",
+        "allow_mkchar", "allow_truncate", "allow_symlink", "allow_rewrite"])
+    def __init__(self, policy="system", version="tomoyo", securityfs=SECURITYFS, delta=True, cache=None, jobs=None, history=None):
+        """Initializes the policy class.
+
+        If version is "tomoyo", LSM version of tomoyo is used.
+        Otherwise, if policy is "ccs", Tomoyo 1.6 policy is used.
+
+        If policy=system, reads policy from /etc/(tomoyo,ccs)/domain_policy.conf.
+        If policy=kernel, policy is read from /sys/kernel/security/tomoyo/domain_policy
+
+        securityfs is the location of TOMOYO kernel interface. If delta=True, only
+        the changes are written there when policy is saved and reloaded, instead of
+        reloading the whole policy with tomoyo-loadpolicy.
+
+        If cache is a PolicyCache, parsed policy files are cached there. Large policy
+        files are parsed by up to jobs processes, by default one for each CPU.
+
+        If history is a PolicyHistory, each saved policy is recorded there."""
+        self.mode = policy
+        self.version = version
+        self.securityfs = securityfs
+        self.delta = delta
+        self.cache = cache
+        self.history = history
+        if jobs is None:
+            try:
+                jobs = multiprocessing.cpu_count()
+            except NotImplementedError:
+                jobs = 1
+        self.jobs = jobs
+        if policy == "kernel":
+            self.location = "%s/domain_policy" % securityfs
+        else:
+            self.location = "/etc/%s/domain_policy.conf" % version
+        self.save_location = "domain_policy.conf"
+        # no policy loaded yet
+        self.policy = DomainIndex()
+        self.policy_dict = {}
+        self.policy_tree = []
+        self.policy_profile = {}
+        # error reported by policy tools
+        self.error = None
+        # domains changed since policy was loaded or applied to kernel, with their original settings
+        self.dirty = set()
+        self.original = {}
+        # policy was changed since it was loaded or written
+        self.unsaved = False
+        # policy file as loaded was kept before being overwritten
+        self.kept = False
+
+    def reload(self, progress=None):
+        """Reloads the policy. If using system policy, current kernel policy is saved first"""
+        return self.update(self.load(progress))
+
+    def load(self, progress=None):
+        """Loads the policy without replacing the current one.
+
+        Returns the parsed policy, which should be passed to update(). This is safe
+        to call from a worker thread. If saving kernel policy fails, the reason is
+        stored in self.error."""
+        self.error = None
+        if self.mode == "system":
+            with profile("savepolicy domains"):
+                status, self.error = run_command(self.POLICY_SAVE)
+            if status != 0:
+                print >>sys.stderr, "Unable to save kernel policy: %s" % self.error
+            else:
+                self.error = None
+        with profile("parse domains"):
+            return self.read_policy(self.location, progress)
+
+    def update(self, result):
+        """Replaces current policy by one returned by load()"""
+        success, self.policy, self.policy_dict, self.policy_tree, self.policy_profile = result
+        self.dirty = set()
+        self.original = {}
+        self.unsaved = False
+        self.kept = False
+        return success
+
+    def is_modified(self):
+        """Returns True if policy has unsaved changes"""
+        return self.unsaved
+
+    def touch(self, domain):
+        """Marks a domain as changed. Must be called before the domain is changed"""
+        self.unsaved = True
+        if domain in self.dirty:
+            return
+        self.dirty.add(domain)
+        if domain in self.policy_dict:
+            self.original[domain] = (self.policy_profile.get(domain, 0), list(self.policy_dict[domain]))
+        else:
+            # new domain
+            self.original[domain] = None
+
+    def set_profile(self, domains, profile):
+        """Changes profile for a list of domains"""
+        for domain in domains:
+            if self.policy_profile.get(domain) != profile:
+                self.touch(domain)
+                self.policy_profile[domain] = profile
+
+    def update_acl(self, domain, pos, acl, item):
+        """Changes an ACL entry of a domain"""
+        self.touch(domain)
+        self.policy_dict[domain][pos] = (acl, item)
+
+    def delete_acl(self, domain, pos):
+        """Removes an ACL entry from a domain"""
+        self.touch(domain)
+        del self.policy_dict[domain][pos]
+
+    def compact(self, exceptions, domains=None):
+        """Finds redundant ACL entries, without changing the policy.
+
+        Exact duplicates are removed. Single pathnames matching a file_pattern exception
+        are replaced by the pattern, as learning mode would do, but only when the pattern
+        merges two or more entries of the domain, so that no permission is widened just
+        to rewrite an entry. allow_read entries already granted to all domains
+        by allow_read exceptions are removed; patterns are only removed when the very
+        same pattern is an exception, as a pattern matching another one does not
+        grant everything it covers.
+
+        Returns a list of (domain, acl, duplicates, collapsed, granted, saved) tuples
+        for domains where compacting saves space, where acl is the compacted ACL and
+        saved the number of bytes saved. Pass it to apply_compaction() to change the policy."""
+        if domains is None:
+            domains = self.policy
+        file_patterns = exceptions.matcher("file_pattern")
+        read_patterns = exceptions.matcher("allow_read")
+        read_exceptions = exceptions.exceptions["allow_read"]
+        compacted = []
+        for domain in domains:
+            old_acl = self.policy_dict[domain]
+            # number of distinct entries covered by each pattern
+            patterns = {}
+            counts = {}
+            for entry in set(old_acl):
+                command, params = entry
+                if command not in self.SINGLE_PATH_ACL:
+                    continue
+                if not is_pattern(params):
+                    pattern = file_patterns.find(params)
+                    if pattern is None or pattern == params:
+                        continue
+                    patterns[entry] = entry = (command, pattern)
+                counts[entry] = counts.get(entry, 0) + 1
+            acl = []
+            seen = set()
+            duplicates = collapsed = granted = 0
+            for entry in old_acl:
+                if entry in seen:
+                    duplicates += 1
+                    continue
+                seen.add(entry)
+                pattern = patterns.get(entry)
+                if pattern is not None and counts[pattern] > 1:
+                    entry = pattern
+                    if entry in seen:
+                        collapsed += 1
+                        continue
+                    seen.add(entry)
+                if entry[0] == "allow_read":
+                    if entry[1] in read_exceptions or (not is_pattern(entry[1]) and read_patterns.match(entry[1])):
+                        granted += 1
+                        continue
+                acl.append(entry)
+            if acl != old_acl:
+                saved = sum([len(command) + len(params) + 2 for command, params in old_acl]) - \
+                        sum([len(command) + len(params) + 2 for command, params in acl])
+                if saved <= 0:
+                    continue
+                compacted.append((domain, acl, duplicates, collapsed, granted, saved))
+        return compacted
+
+    def acl_lines(self, domain):
+        """Returns ACL entries of a domain as lines of text, without parsing mapped domains"""
+        if isinstance(self.policy_dict, MappedPolicy):
+            acl = self.policy_dict.raw_acl(domain)
+            if acl is not None:
+                return [line for line in [line.strip() for line in acl.split("\n")] if line]
+        return ["%s %s" % params for params in self.policy_dict[domain]]
+
+    def fingerprint(self, domain):
+        """Returns fingerprint of profile and ACL set of a domain"""
+        return policy_fingerprint(self.policy_profile.get(domain, 0), self.acl_lines(domain))
+
+    def apply_compaction(self, compacted):
+        """Replaces ACL of domains by compacted ones returned by compact()"""
+        for item in compacted:
+            domain, acl = item[:2]
+            self.touch(domain)
+            self.policy_dict[domain] = acl
+
+    def format_changes(self):
+        """Formats changes made since policy was loaded.
+
+        Yields statements for each changed domain, in the syntax accepted by
+        TOMOYO domain_policy interface: domain name selects the domain, followed by
+        its new profile, removed ACL (prefixed by "delete") and added ACL."""
+        for domain in self.policy:
+            if domain not in self.dirty:
+                continue
+            profile = self.policy_profile.get(domain, 0)
+            acl = self.policy_dict[domain]
+            original = self.original.get(domain)
+            if original:
+                old_profile, old_acl = original
+            else:
+                old_profile, old_acl = None, []
+            lines = ["%s\n" % domain]
+            if profile != old_profile:
+                lines.append("use_profile %d\n" % profile)
+            current = set(acl)
+            for params in set(old_acl):
+                if params not in current:
+                    lines.append("delete %s %s\n" % params)
+            previous = set(old_acl)
+            for params in acl:
+                if params not in previous:
+                    lines.append("%s %s\n" % params)
+                    # only add duplicated entries once
+                    previous.add(params)
+            yield "".join(lines)
+
+    def apply_changes(self):
+        """Writes changes made since policy was loaded directly into kernel"""
+        try:
+            write_kernel_policy("%s/domain_policy" % self.securityfs, self.format_changes())
+        except:
+            print >>sys.stderr, "Unable to apply TOMOYO policy changes: %s" % sys.exc_value
+            return False
+        return True
+
+    def parse_policy(self, fd):
+        """Parses a policy file line by line.
+
+        Yields (offset, domain, acl) tuples, where offset is the number of bytes
+        consumed so far and acl is None for domain headers or a (command, params)
+        tuple for ACL entries. Raises ValueError on syntax errors."""
+        offset = 0
+        domain = None
+        for line in fd:
+            offset += len(line)
+            line = line.strip()
+            if not line:
+                continue
+            if line.find('<kernel>') == 0:
+                # it is a security domain
+                domain = line
+                yield offset, domain, None
+            elif domain is None:
+                raise ValueError("ACL outside of a domain: %s" % line)
+            else:
+                command, params = line.split(" ", 1)
+                yield offset, domain, (command, params)
+
+    def read_policy(self, location, progress=None):
+        """Reads a policy from file.
+
+        Regular files are memory-mapped, and the ACL of each domain is only parsed when
+        accessed (see MappedPolicy). Other files are parsed as a stream, so only the
+        parsed structures are kept in memory. If progress is specified, it is called as
+        progress(bytes_read, total_bytes) while the file is being parsed.
+
+        Returns (success, domains, domains_dict, domains_tree, domains_profile), where
+        domains_profile holds the use_profile setting of each domain, which is not
+        included in the domains_dict list of ACL."""
+        data = self.map_policy(location)
+        if data is not None:
+            return self.scan_policy(location, data, progress)
+        success = True
+        domains = DomainIndex()
+        domains_dict = {}
+        domains_profile = {}
+        try:
+            fd = open(location)
+        except:
+            # unable to open policy file
+            print >>sys.stderr, "Unable to open policy file: %s" % location
+            return False, domains, domains_dict, [], domains_profile
+        # securityfs files do not report their size
+        total = os.fstat(fd.fileno()).st_size
+        next_report = 0
+        offset = 0
+        try:
+            for offset, domain, acl in self.parse_policy(fd):
+                if progress and offset >= next_report:
+                    progress(offset, total)
+                    next_report = offset + self.PROGRESS_STEP
+                if not acl:
+                    if domains.append(domain):
+                        domains_dict[domain] = []
+                        domains_profile[domain] = 0
+                elif acl[0] == 'use_profile':
+                    domains_profile[domain] = int(acl[1])
+                else:
+                    domains_dict[domain].append(acl)
+        except ValueError:
+            # syntax error?
+            print >>sys.stderr, "Syntax error in policy file %s: %s" % (location, sys.exc_value)
+            success = False
+        finally:
+            fd.close()
+        if progress:
+            progress(offset, total)
+        domains.sort()
+        return success, domains, domains_dict, self.build_tree(domains), domains_profile
+
+    def map_policy(self, location):
+        """Maps a regular policy file into memory. Returns None if it cannot be mapped"""
+        try:
+            with open(location, "rb") as fd:
+                if not S_ISREG(os.fstat(fd.fileno()).st_mode):
+                    return None
+                return mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            # empty or unreadable file
+            return None
+
+    def scan_policy(self, location, data, progress=None):
+        """Reads a memory-mapped policy file.
+
+        Only domain headers and profiles are parsed, ACL entries are recorded by their
+        position in the file. Syntax errors in ACL entries are still detected. Large
+        files are split into chunks which are scanned in parallel processes."""
+        if self.cache:
+            cached = self.cache.load("domain_spans", location)
+            if cached:
+                domains, spans, domains_tree, domains_profile = cached
+                return True, DomainIndex(domains), MappedPolicy(data, spans), domains_tree, domains_profile
+        success = True
+        domains = DomainIndex()
+        spans = {}
+        domains_profile = {}
+        total = len(data)
+        try:
+            if self.jobs > 1 and total >= self.PARALLEL_SIZE:
+                chunks = self.scan_parallel(location, data, progress)
+            else:
+                chunks = [scan_policy_chunk(data, 0, total, progress)]
+            # chunks are merged in file order
+            for chunk_domains, chunk_spans, chunk_profile in chunks:
+                for domain in chunk_domains:
+                    if domains.append(domain):
+                        spans[domain] = chunk_spans[domain]
+                        domains_profile[domain] = 0
+                    else:
+                        spans[domain].extend(chunk_spans[domain])
+                domains_profile.update(chunk_profile)
+        except ValueError:
+            # syntax error?
+            print >>sys.stderr, "Syntax error in policy file %s: %s" % (location, sys.exc_value)
+            success = False
+        if progress:
+            progress(total, total)
+        domains.sort()
+        domains_tree = self.build_tree(domains)
+        if success and self.cache:
+            self.cache.store("domain_spans", location, (list(domains), spans, domains_tree, domains_profile))
+        return success, domains, MappedPolicy(data, spans), domains_tree, domains_profile
+
+    def scan_parallel(self, location, data, progress=None):
+        """Scans a memory-mapped policy file in a pool of processes.
+
+        The file is split into chunks at domain headers, and the list of scanned
+        chunks is returned in file order."""
+        total = len(data)
+        num_chunks = self.jobs * 4
+        bounds = [0]
+        for pos in range(1, num_chunks):
+            start = data.find("\n<kernel>", max(bounds[-1], total * pos / num_chunks))
+            if start < 0:
+                break
+            bounds.append(start + 1)
+        bounds.append(total)
+        try:
+            pool = multiprocessing.Pool(self.jobs)
+        except:
+            # no support for process pools
+            print >>sys.stderr, "Unable to start parsing processes: %s" % sys.exc_value
+            return [scan_policy_chunk(data, 0, total, progress)]
+        try:
+            chunks = []
+            ranges = [(location, start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+            for chunk in pool.imap(scan_policy_file, ranges):
+                chunks.append(chunk)
+                if progress:
+                    progress(ranges[len(chunks) - 1][2], total)
+            return chunks
+        finally:
+            # terminating workers while they send results may hang the pool
+            pool.close()
+            pool.join()
+
+    def build_tree(self, domains):
+        """Builds description of domains hierarchy.
+
+        Domains must be sorted, so each domain is followed by its subdomains. Returns a
+        list of (path, level, end) tuples, one for each domain, where path is the domain
+        name with components shared with previous domain replaced by spaces, and end is
+        the position after the last subdomain of the domain."""
+        # subtree ranges
+        ends = [len(domains)] * len(domains)
+        parents = []
+        for pos, domain in enumerate(domains):
+            while parents and not domain.startswith(domains[parents[-1]] + " "):
+                ends[parents.pop()] = pos
+            parents.append(pos)
+
+        domains_tree = []
+        path = []
+        for pos, domain in enumerate(domains):
+            items = domain.split(" ")
+            depth = len(items)
+            last_depth = len(path) -1
+            if depth >= last_depth:
+                del path[depth:]
+            curitems = []
+            curlevel = 0
+            # rebuilt item description
+            for i in range(depth):
+                if i > last_depth:
+                    path += items[i:]
+                    curitems += items[i:]
+                    break
+                if items[i] == path[i]:
+                    curitems.append("  ")
+                    curlevel += 1
+                    continue
+                curitems.append(items[i])
+                path[i] = items[i]
+            curpath = " ".join(curitems)
+            domains_tree.append((curpath, curlevel, ends[pos]))
+        return domains_tree
+
+    def subtree(self, domain):
+        """Returns (start, end) range of positions of a domain and its subdomains"""
+        start = self.policy.index(domain)
+        path, level, end = self.policy_tree[start]
+        return start, end
+
+    def subdomains(self, domain):
+        """Returns a domain and all its subdomains"""
+        start, end = self.subtree(domain)
+        return self.policy[start:end]
+
+    def import_policy(self, location, merge=False, unmerge=False):
+        """Imports part of policy, such as an application profile.
+
+        If merge=True, imported policy is merged into the system one: new domains are
+        added, and imported ACL entries are added to the ACL of known domains, which
+        keep their own entries and profile. If unmerge=True, ACL entries of imported
+        domains are removed from the system policy instead; domains themselves are kept.
+        Otherwise, the policy is not changed.
+
+        ACL of each domain is compared as a set, so importing takes linear time.
+        Returns (num_updates, domains), where num_updates is the number of imported
+        domains already in the policy, or -1 if the policy could not be imported."""
+        try:
+            if DEBUG:
+                print "Importing from %s" % location
+            success, domains, domains_dict, domains_tree, domains_profile = self.read_policy(location)
+            if not success:
+                # import error
+                return -1, []
+            num_updates = 0
+            new_domains = []
+            for domain in domains:
+                if domain not in self.policy:
+                    new_domains.append(domain)
+                    continue
+                num_updates += 1
+                if merge:
+                    # union of ACL sets
+                    known = set(self.policy_dict[domain])
+                    added = []
+                    for entry in domains_dict[domain]:
+                        if entry not in known:
+                            known.add(entry)
+                            added.append(entry)
+                    if added:
+                        self.touch(domain)
+                        self.policy_dict[domain].extend(added)
+                elif unmerge:
+                    # difference of ACL sets
+                    removed = set(domains_dict[domain])
+                    acl = self.policy_dict[domain]
+                    remaining = [entry for entry in acl if entry not in removed]
+                    if len(remaining) < len(acl):
+                        self.touch(domain)
+                        self.policy_dict[domain] = remaining
+            if merge and new_domains:
+                for domain in new_domains:
+                    self.touch(domain)
+                    self.policy_dict[domain] = list(domains_dict[domain])
+                    self.policy_profile[domain] = domains_profile.get(domain, 0)
+                # a new index is built, as views may still refer to the current one
+                index = DomainIndex(self.policy)
+                index.extend(new_domains)
+                index.sort()
+                self.policy = index
+                self.policy_tree = self.build_tree(self.policy)
+            return num_updates, domains
+        except:
+            # something is wrong with the policy format
+            traceback.print_exc()
+            return -1, []
+
+    def save(self, reload=True):
+        """Saves the policy. If reload=True, the saved policy is loaded into kernel.
+
+        The policy file is only written if it has unsaved changes, and changes which
+        were saved earlier but not applied yet are loaded into kernel as well."""
+        if not self.unsaved and not (reload and self.dirty):
+            return True
+        self.error = None
+        if self.unsaved:
+            try:
+                # new policy is fully written before replacing the old one
+                with profile("save domains"):
+                    location = os.path.realpath(self.location)
+                    backup = None
+                    if not self.kept:
+                        # policy as loaded can be restored from history or backup file
+                        if self.history:
+                            self.history.record_file("domain", location, self.location)
+                        backup = "%s.old" % location
+                    blocks = self.format_policy(self.policy)
+                    if self.history:
+                        recorder = self.history.recorder("domain")
+                        blocks = recorder.record(self.policy, blocks)
+                    write_file(location, blocks, backup=backup)
+                    self.kept = True
+                    if self.history:
+                        recorder.commit(self.location)
+            except:
+                print >>sys.stderr, "Unable to save TOMOYO policy: %s" % sys.exc_value
+                self.error = "%s" % sys.exc_value
+                return False
+            self.unsaved = False
+        if reload and self.dirty:
+            # only changed domains are written into kernel when possible
+            with profile("loadpolicy domains"):
+                status, error = 0, None
+                if not (self.delta and self.apply_changes()):
+                    status, error = run_command(self.POLICY_LOAD)
+            if status != 0:
+                print >>sys.stderr, "Unable to load TOMOYO policy: %s" % error
+                self.error = error
+                return False
+            self.dirty = set()
+            self.original = {}
+        return True
+
+    def write_policy(self, filename, entries):
+        """Exports specified entries to a file"""
+        write_file(filename, self.format_policy(entries))
+
+    def format_policy(self, entries):
+        """Formats specified entries, yielding a block of text for each domain"""
+        mapped = isinstance(self.policy_dict, MappedPolicy)
+        for item in entries:
+            # domains which were never parsed are copied from the policy file
+            acl = None
+            if mapped:
+                acl = self.policy_dict.raw_acl(item)
+            if acl is None:
+                acl = "".join(["%s %s\n" % params for params in self.policy_dict[item]])
+            # compatibility with tomoyo-savepolicy
+            yield "%s\n\nuse_profile %d\n\n%s\n" % (item, self.policy_profile.get(item, 0), acl)
+
+class TomoyoExceptions:
+    POLICY_LOAD="/usr/sbin/tomoyo-loadpolicy fe"
+    POLICY_SAVE="/usr/sbin/tomoyo-savepolicy fe"
+    SECURITYFS=TomoyoPolicy.SECURITYFS
+    # known exception types
+    EXCEPTIONS=["file_pattern", "allow_read", "deny_rewrite", "alias", "initialize_domain", "no_initialize_domain", "keep_domain", "no_keep_domain"]
+    def __init__(self, policy="system", version="tomoyo", securityfs=SECURITYFS, delta=True, cache=None, history=None):
+        """Initializes the exceptions class.
+
+        If version is "tomoyo", LSM version of tomoyo is used.
+        Otherwise, if policy is "ccs", Tomoyo 1.6 policy is used.
+
+        If policy=system, reads policy from /etc/(tomoyo,ccs)/exceptions.
+        If policy=kernel, policy is read from /sys/kernel/security/tomoyo/exceptions
+
+        securityfs is the location of TOMOYO kernel interface. If delta=True, only
+        the changes are written there when exceptions are saved and reloaded.
+
+        If cache is a PolicyCache, parsed exception files are cached there. If history
+        is a PolicyHistory, each saved exception policy is recorded there."""
+        self.mode = policy
+        self.version = version
+        self.securityfs = securityfs
+        self.delta = delta
+        self.cache = cache
+        self.history = history
+        if policy == "kernel":
+            self.exceptions_location = "%s/exception_policy" % securityfs
+        else:
+            self.exceptions_location = "/etc/%s/exception_policy.conf" % version
+        self.save_location = "exceptions_policy.conf"
+        # no exceptions loaded yet
+        self.exceptions = self.empty_exceptions()
+        # error reported by policy tools
+        self.error = None
+        # exception types changed since exceptions were loaded or applied to kernel, with their original entries
+        self.dirty = set()
+        self.original = {}
+        # exceptions were changed since they were loaded or written
+        self.unsaved = False
+        # exceptions file as loaded was kept before being overwritten
+        self.kept = False
+        # compiled patterns of each exception type
+        self.matchers = {}
+
+    def empty_exceptions(self):
+        """Returns an empty set of exceptions of known types"""
+        exceptions = {}
+        for exc in self.EXCEPTIONS:
+            exceptions[exc] = ExceptionStore()
+        return exceptions
+
+    def reload(self, progress=None):
+        """Reloads the policy. If using system policy, current kernel policy is saved first"""
+        return self.update(self.load(progress))
+
+    def load(self, progress=None):
+        """Loads the exceptions without replacing the current ones.
+
+        Returns the parsed exceptions, which should be passed to update(). This is
+        safe to call from a worker thread. If saving kernel exceptions fails, the
+        reason is stored in self.error."""
+        self.error = None
+        if self.mode == "system":
+            with profile("savepolicy exceptions"):
+                status, self.error = run_command(self.POLICY_SAVE)
+            if status != 0:
+                print >>sys.stderr, "Unable to save kernel exceptions: %s" % self.error
+            else:
+                self.error = None
+        with profile("parse exceptions"):
+            return self.read_policy(self.exceptions_location, progress)
+
+    def update(self, result):
+        """Replaces current exceptions by ones returned by load()"""
+        success, self.exceptions = result
+        self.dirty = set()
+        self.original = {}
+        self.unsaved = False
+        self.kept = False
+        self.matchers = {}
+        return success
+
+    def is_modified(self):
+        """Returns True if exceptions have unsaved changes"""
+        return self.unsaved
+
+    def touch(self, type):
+        """Marks an exception type as changed. Must be called before it is changed"""
+        self.matchers.pop(type, None)
+        self.unsaved = True
+        if type in self.dirty:
+            return
+        self.dirty.add(type)
+        self.original[type] = list(self.exceptions.get(type, []))
+
+    def matcher(self, type):
+        """Returns a PatternMatcher for pathnames of an exception type, such as allow_read"""
+        if type not in self.matchers:
+            self.matchers[type] = PatternMatcher(self.exceptions.get(type, []))
+        return self.matchers[type]
+
+    def update_exception(self, type, id, item):
+        """Changes an exception, returning its id"""
+        self.touch(type)
+        return self.exceptions[type].update(id, item)
+
+    def delete_exception(self, type, id):
+        """Removes an exception"""
+        self.touch(type)
+        self.exceptions[type].remove(id)
+
+    def format_changes(self):
+        """Formats changes made since exceptions were loaded.
+
+        Yields statements for each changed exception type, in the syntax accepted
+        by TOMOYO exception_policy interface."""
+        for type in self.dirty:
+            current = set(self.exceptions.get(type, []))
+            previous = set(self.original[type])
+            lines = []
+            for item in previous - current:
+                lines.append("delete %s %s\n" % (type, item))
+            for item in current - previous:
+                lines.append("%s %s\n" % (type, item))
+            yield "".join(lines)
+
+    def apply_changes(self):
+        """Writes changes made since exceptions were loaded directly into kernel"""
+        try:
+            write_kernel_policy("%s/exception_policy" % self.securityfs, self.format_changes())
+        except:
+            print >>sys.stderr, "Unable to apply TOMOYO exception changes: %s" % sys.exc_value
+            return False
+        return True
+
+    def read_policy(self, location, progress=None):
+        """Reads a policy from file.
+
+        If progress is specified, it is called as progress(bytes_read, total_bytes)
+        while the file is being parsed."""
+        if self.cache:
+            cached = self.cache.load("exception_policy", location)
+            if cached:
+                exceptions = {}
+                for type in cached:
+                    exceptions[type] = ExceptionStore(cached[type])
+                return True, exceptions
+        success = True
+        # parse exceptions
+        exceptions = self.empty_exceptions()
+        try:
+            fd = open(location)
+        except:
+            # unable to open policy file
+            print >>sys.stderr, "Unable to open exceptions file: %s" % location
+            return False, exceptions
+        total = os.fstat(fd.fileno()).st_size
+        next_report = 0
+        offset = 0
+        try:
+            for line in fd:
+                offset += len(line)
+                if progress and offset >= next_report:
+                    progress(offset, total)
+                    next_report = offset + TomoyoPolicy.PROGRESS_STEP
+                line = line.strip()
+                if not line:
+                    continue
+                acl, params = line.split(" ", 1)
+                if acl not in exceptions:
+                    exceptions[acl] = ExceptionStore()
+                # duplicate exceptions are only kept once
+                exceptions[acl].add(params)
+        except ValueError:
+            print >>sys.stderr, "Syntax error in exceptions file %s: %s" % (location, sys.exc_value)
+            success = False
+        finally:
+            fd.close()
+        if progress:
+            progress(offset, total)
+        if success and self.cache:
+            cached = {}
+            for type in exceptions:
+                cached[type] = list(exceptions[type])
+            self.cache.store("exception_policy", location, cached)
+        return success, exceptions
+
+    def save(self, reload=True):
+        """Saves the policy. If reload=True, the saved policy is loaded into kernel.
+
+        The exceptions file is only written if it has unsaved changes, and changes
+        which were saved earlier but not applied yet are loaded into kernel as well."""
+        if not self.unsaved and not (reload and self.dirty):
+            return True
+        self.error = None
+        if self.unsaved:
+            try:
+                # new exceptions are fully written before replacing the old ones
+                with profile("save exceptions"):
+                    location = os.path.realpath(self.exceptions_location)
+                    backup = None
+                    if not self.kept:
+                        # exceptions as loaded can be restored from history or backup file
+                        if self.history:
+                            self.history.record_file("exception", location, self.exceptions_location)
+                        backup = "%s.old" % location
+                    blocks = self.format_exceptions(self.exceptions)
+                    if self.history:
+                        recorder = self.history.recorder("exception")
+                        blocks = recorder.record(list(self.exceptions), blocks)
+                    write_file(location, blocks, backup=backup)
+                    self.kept = True
+                    if self.history:
+                        recorder.commit(self.exceptions_location)
+            except:
+                traceback.print_exc()
+                print >>sys.stderr, "Unable to save TOMOYO exceptions: %s" % sys.exc_value
+                self.error = "%s" % sys.exc_value
+                return False
+            self.unsaved = False
+        if reload and self.dirty:
+            # only changed exceptions are written into kernel when possible
+            with profile("loadpolicy exceptions"):
+                status, error = 0, None
+                if not (self.delta and self.apply_changes()):
+                    status, error = run_command(self.POLICY_LOAD)
+            if status != 0:
+                print >>sys.stderr, "Unable to load TOMOYO exceptions: %s" % error
+                self.error = error
+                return False
+            self.dirty = set()
+            self.original = {}
+        return True
+
+    def write_exceptions(self, filename, entries):
+        """Exports specified entries to a file"""
+        write_file(filename, self.format_exceptions(entries))
+
+    def format_exceptions(self, entries):
+        """Formats specified entries, yielding a block of text for each exception type"""
+        for item in entries:
+            yield "".join(["%s %s\n" % (item, val) for val in entries[item]])
+
+class PolicyDiff:
+    """Differences between two policies.
+
+    Each domain is summarized by a fingerprint of its profile and ACL set, and ACL
+    entries are only compared for domains whose fingerprints differ. Domains with the
+    same text in both memory-mapped policy files are skipped without being parsed.
+    Domains of both policies must be sorted, so comparing takes linear time.
+
+    Policies are TomoyoPolicy instances, or objects with the same policy and
+    policy_profile attributes and acl_lines() and fingerprint() methods."""
+    def __init__(self, old, new):
+        """Compares old and new policies"""
+        # (domain, old_profile, new_profile, added_acl, removed_acl) tuples, where
+        # profiles are None for added and removed domains
+        self.changes = []
+        self.added = self.removed = self.changed = 0
+        self.added_acl = self.removed_acl = 0
+        self.compare(old, new)
+
+    def compare(self, old, new):
+        """Walks through both sorted lists of domains"""
+        old_domains = iter(old.policy)
+        new_domains = iter(new.policy)
+        old_domain = next(old_domains, None)
+        new_domain = next(new_domains, None)
+        while old_domain is not None or new_domain is not None:
+            if new_domain is None or (old_domain is not None and old_domain < new_domain):
+                self.add_change(old_domain, old.policy_profile.get(old_domain, 0), None, [], old.acl_lines(old_domain))
+                old_domain = next(old_domains, None)
+            elif old_domain is None or new_domain < old_domain:
+                self.add_change(new_domain, None, new.policy_profile.get(new_domain, 0), new.acl_lines(new_domain), [])
+                new_domain = next(new_domains, None)
+            else:
+                self.compare_domain(old, new, new_domain)
+                old_domain = next(old_domains, None)
+                new_domain = next(new_domains, None)
+
+    def compare_domain(self, old, new, domain):
+        """Compares a domain found in both policies"""
+        old_profile = old.policy_profile.get(domain, 0)
+        new_profile = new.policy_profile.get(domain, 0)
+        if old_profile == new_profile:
+            old_raw = self.raw_acl(old, domain)
+            if old_raw is not None and old_raw == self.raw_acl(new, domain):
+                return
+        if old.fingerprint(domain) == new.fingerprint(domain):
+            return
+        old_lines = old.acl_lines(domain)
+        new_lines = new.acl_lines(domain)
+        old_acl = set(old_lines)
+        new_acl = set(new_lines)
+        added = []
+        for line in new_lines:
+            if line not in old_acl:
+                added.append(line)
+                # only report duplicated entries once
+                old_acl.add(line)
+        removed = []
+        for line in old_lines:
+            if line not in new_acl:
+                removed.append(line)
+                new_acl.add(line)
+        self.add_change(domain, old_profile, new_profile, added, removed)
+
+    def raw_acl(self, policy, domain):
+        """Returns ACL text of a domain which was never parsed, or None"""
+        if isinstance(getattr(policy, "policy_dict", None), MappedPolicy):
+            return policy.policy_dict.raw_acl(domain)
+        return None
+
+    def add_change(self, domain, old_profile, new_profile, added, removed):
+        """Records changes of a domain"""
+        if old_profile is None:
+            self.added += 1
+        elif new_profile is None:
+            self.removed += 1
+        else:
+            self.changed += 1
+        self.added_acl += len(added)
+        self.removed_acl += len(removed)
+        self.changes.append((domain, old_profile, new_profile, added, removed))
+
+    def __len__(self):
+        return len(self.changes)
+
+    def format(self):
+        """Formats differences, yielding a block of text for each domain.
+
+        Domain names are prefixed by + for added domains, - for removed domains and a
+        space for changed ones, followed by changed profile and ACL entries."""
+        for domain, old_profile, new_profile, added, removed in self.changes:
+            if old_profile is None:
+                lines = ["+%s\n" % domain, "\t+use_profile %d\n" % new_profile]
+            elif new_profile is None:
+                lines = ["-%s\n" % domain, "\t-use_profile %d\n" % old_profile]
+            else:
+                lines = [" %s\n" % domain]
+                if old_profile != new_profile:
+                    lines.append("\t-use_profile %d\n\t+use_profile %d\n" % (old_profile, new_profile))
+            lines.extend(["\t-%s\n" % line for line in removed])
+            lines.extend(["\t+%s\n" % line for line in added])
+            yield "".join(lines)
+
+def open_policy(source, securityfs=TomoyoPolicy.SECURITYFS, version="tomoyo", cache=None, jobs=None):
+    """Returns a TomoyoPolicy reading a policy source, which is not loaded yet.
+
+    source is "kernel" for the policy loaded into kernel, "system" for the system
+    policy file, or the name of a policy file. Kernel policy is never saved into the
+    system policy file when the source is loaded."""
+    policy = TomoyoPolicy(policy="file", version=version, securityfs=securityfs, cache=cache, jobs=jobs)
+    if source == "kernel":
+        policy.location = "%s/domain_policy" % securityfs
+    elif source != "system":
+        policy.location = source
+    return policy
+
+class ExceptionsView:
+    """Presents exceptions to PolicyDiff as a policy, with exception types as domains"""
+    def __init__(self, exceptions):
+        """Initializes the view of a dictionary of ExceptionStore"""
+        self.exceptions = exceptions
+        self.policy = sorted(exceptions)
+        self.policy_profile = {}
+
+    def acl_lines(self, type):
+        """Returns exceptions of a type"""
+        return list(self.exceptions[type])
+
+    def fingerprint(self, type):
+        """Returns fingerprint of the set of exceptions of a type"""
+        return policy_fingerprint(0, self.acl_lines(type))
+
+class PolicyHistory:
+    """Content-addressed store of saved policies.
+
+    Saved files are split into chunks of consecutive blocks, one block for each domain
+    or exception type. Each chunk is stored once under the digest of its contents,
+    compressed with zlib if compress=True. Chunks end after blocks chosen by their
+    names, so adding or changing a domain only changes the chunk around it. The list
+    of chunks of a save is itself split and stored the same way, and the manifest of
+    each save only lists the parts of its list. Disk use thus grows with the amount
+    of change rather than with the number of saves."""
+    HISTORY_DIR="/var/lib/tomoyo-gui/history"
+    # average number of blocks in a chunk
+    CHUNK_BLOCKS=32
+    # bumped whenever the format of manifests changes
+    VERSION=1
+
+    def __init__(self, directory=HISTORY_DIR, compress=True):
+        """Initializes the history in a directory"""
+        self.directory = directory
+        self.compress = compress
+        self.objects_dir = os.path.join(directory, "objects")
+        self.manifests_dir = os.path.join(directory, "manifests")
+
+    def object_file(self, digest):
+        """Returns name of the file holding a chunk"""
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def store_object(self, data):
+        """Stores a chunk unless it is already known. Returns its digest and the number of bytes written"""
+        digest = hashlib.md5(data).hexdigest()
+        filename = self.object_file(digest)
+        if os.path.exists(filename):
+            return digest, 0
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename), 0700)
+        # first byte tells how the chunk is stored
+        if self.compress:
+            data = "z%s" % zlib.compress(data)
+        else:
+            data = "r%s" % data
+        write_file(filename, [data])
+        return digest, len(data)
+
+    def load_object(self, digest):
+        """Returns contents of a chunk. Raises ValueError if it is damaged"""
+        with open(self.object_file(digest), "rb") as fd:
+            data = fd.read()
+        if data[:1] == "z":
+            data = zlib.decompress(data[1:])
+        elif data[:1] == "r":
+            data = data[1:]
+        else:
+            raise ValueError("Unknown chunk format: %s" % digest)
+        if hashlib.md5(data).hexdigest() != digest:
+            raise ValueError("Damaged chunk: %s" % digest)
+        return data
+
+    def store_index(self, chunks):
+        """Stores a list of chunks. Returns digests of its parts and the number of bytes written"""
+        index = []
+        stored = 0
+        part = []
+        for pos, digest in enumerate(chunks):
+            part.append(digest)
+            if int(digest[:8], 16) % self.CHUNK_BLOCKS == 0 or pos == len(chunks) - 1:
+                digest, size = self.store_object("".join(["%s\n" % item for item in part]))
+                index.append(digest)
+                stored += size
+                part = []
+        return index, stored
+
+    def chunks(self, id):
+        """Returns the list of chunks of a save"""
+        chunks = []
+        for digest in self.manifest(id)["index"]:
+            chunks.extend(self.load_object(digest).split())
+        return chunks
+
+    def recorder(self, kind):
+        """Returns a HistoryRecorder for a new save of a kind of policy, domain or exception"""
+        return HistoryRecorder(self, kind)
+
+    def record_file(self, kind, filename, location):
+        """Records an existing policy file, such as a loaded policy before it is overwritten.
+
+        Nothing new is recorded if the file is the latest save of location.
+        Returns id of the save, or None if the file could not be recorded."""
+        try:
+            fd = open(filename)
+        except IOError:
+            return None
+        with fd:
+            recorder = self.recorder(kind)
+            names, blocks = tee(policy_blocks(fd, kind))
+            for block in recorder.record((item[0] for item in names), (item[1] for item in blocks)):
+                pass
+        try:
+            latest = [id for id, manifest in self.saves() if manifest["kind"] == kind and manifest["location"] == location]
+            if latest and not recorder.error and self.chunks(latest[-1]) == recorder.chunks:
+                return latest[-1]
+        except:
+            print >>sys.stderr, "Unable to read %s policy history: %s" % (kind, sys.exc_value)
+        return recorder.commit(location)
+
+    def manifest_file(self, id):
+        """Returns name of the manifest of a save"""
+        return os.path.join(self.manifests_dir, "%s.json" % id)
+
+    def exists(self, id):
+        """Returns True if id is a known save"""
+        return "/" not in id and os.path.exists(self.manifest_file(id))
+
+    def manifest(self, id):
+        """Returns the manifest of a save"""
+        with open(self.manifest_file(id)) as fd:
+            return json.load(fd)
+
+    def saves(self):
+        """Returns (id, manifest) of each save, oldest first"""
+        try:
+            names = os.listdir(self.manifests_dir)
+        except OSError:
+            return []
+        saves = []
+        for name in sorted(names):
+            if name.endswith(".json"):
+                id = name[:-5]
+                saves.append((id, self.manifest(id)))
+        return saves
+
+    def restore(self, id, filename):
+        """Writes a saved policy into a file"""
+        write_file(filename, (self.load_object(digest) for digest in self.chunks(id)))
+
+    def diff(self, old_id, new_id, jobs=None):
+        """Returns a PolicyDiff between two saves of the same kind.
+
+        Chunks found in both saves hold the same blocks, so only the other chunks are
+        restored and compared."""
+        kind = self.manifest(old_id)["kind"]
+        if self.manifest(new_id)["kind"] != kind:
+            raise ValueError("Unable to compare %s policy with %s policy" % (kind, self.manifest(new_id)["kind"]))
+        chunks = [self.chunks(old_id), self.chunks(new_id)]
+        shared = set(chunks[0]) & set(chunks[1])
+        tmpdir = tempfile.mkdtemp(prefix="tomoyo-history.")
+        try:
+            policies = []
+            for id, saved in zip([old_id, new_id], chunks):
+                filename = os.path.join(tmpdir, id)
+                write_file(filename, (self.load_object(digest) for digest in saved if digest not in shared))
+                if kind == "domain":
+                    policy = open_policy(filename, jobs=jobs)
+                    success = policy.update(policy.load())
+                else:
+                    success, exceptions = TomoyoExceptions(policy="file").read_policy(filename)
+                    policy = ExceptionsView(exceptions)
+                if not success:
+                    raise ValueError("Unable to read saved policy: %s" % id)
+                policies.append(policy)
+            # restored policy files are memory-mapped, and may be removed now
+            return PolicyDiff(policies[0], policies[1])
+        finally:
+            shutil.rmtree(tmpdir)
+
+def policy_blocks(fd, kind):
+    """Splits a policy file into (name, block) pairs, as saved by TomoyoPolicy or TomoyoExceptions.
+
+    Each domain starts a block, while exceptions of the same type are kept in one block."""
+    name = ""
+    lines = []
+    for line in fd:
+        if kind == "domain":
+            key = line.strip()
+            start = line.startswith("<")
+        else:
+            key = line.split(" ", 1)[0]
+            start = key != name
+        if start:
+            if lines:
+                yield name, "".join(lines)
+                lines = []
+            name = key
+        lines.append(line)
+    if lines:
+        yield name, "".join(lines)
+
+class HistoryRecorder:
+    """Records a save into a PolicyHistory while the saved file is written.
+
+    Failing to record a save never prevents the policy from being saved."""
+    def __init__(self, history, kind):
+        """Initializes the recorder"""
+        self.history = history
+        self.kind = kind
+        self.date = datetime.datetime.now()
+        self.chunks = []
+        self.buffer = []
+        self.size = 0
+        self.stored = 0
+        self.blocks = 0
+        self.error = None
+
+    def record(self, names, blocks):
+        """Yields blocks of the saved file, storing them into chunks.
+
+        names are the names of blocks, such as domains, in the same order."""
+        for name, block in izip(names, blocks):
+            self.buffer.append(block)
+            self.blocks += 1
+            if zlib.crc32(name) % self.history.CHUNK_BLOCKS == 0:
+                self.flush()
+            yield block
+        self.flush()
+
+    def flush(self):
+        """Stores blocks gathered so far as a chunk"""
+        data = "".join(self.buffer)
+        self.buffer = []
+        if not data or self.error:
+            return
+        try:
+            digest, stored = self.history.store_object(data)
+        except:
+            self.error = "%s" % sys.exc_value
+            return
+        self.chunks.append(digest)
+        self.size += len(data)
+        self.stored += stored
+
+    def commit(self, location):
+        """Writes the manifest of the save, once the saved file is written"""
+        if self.error:
+            print >>sys.stderr, "Unable to record %s policy history: %s" % (self.kind, self.error)
+            return None
+        id = "%s-%s" % (self.date.strftime("%Y%m%d-%H%M%S.%f"), self.kind)
+        try:
+            index, stored = self.history.store_index(self.chunks)
+            manifest = {"version": self.history.VERSION, "kind": self.kind, "date": self.date.strftime("%F %T"),
+                    "location": location, "blocks": self.blocks, "size": self.size, "stored": self.stored + stored,
+                    "index": index}
+            if not os.path.isdir(self.history.manifests_dir):
+                os.makedirs(self.history.manifests_dir, 0700)
+            write_file(self.history.manifest_file(id), [json.dumps(manifest)])
+        except:
+            print >>sys.stderr, "Unable to record %s policy history: %s" % (self.kind, sys.exc_value)
+            return None
+        return id